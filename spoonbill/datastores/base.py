@@ -1,6 +1,8 @@
+import ast
 import typing
 import cloudpickle
 import re
+from spoonbill.datastores.codecs import DEFAULT_CODECS, TAGS, get_codec, to_tagged, from_tagged
 from spoonbill.filesystem import FileSystem
 
 
@@ -12,37 +14,62 @@ RANDOM_VALUE = '#5f1a7da3a2b04d629231108bb6548dcb#'
 class Strict:
     """
     A class to wrap a dict-like object to make it strict or not.
-    A non-strict dict will encode all keys and values to bytes using cloudpickle.
+    A non-strict dict will encode all keys and values to bytes with the first supporting codec in `codecs`.
+    Every payload starts with a one-byte tag of its codec, so decoding is a lookup - no eval or parsing.
+    If `as_string` is True, the bytes are mapped one-to-one to a string using `encoding` for backends which
+    only accept strings.
     Pros - Very flexiable and can be use in the same way as a normal dict, everywhere.
     Con - On some backends, a loss of functionality and speed is possible.
     """
-    encoding: str = 'cp1252'
+    encoding: str = 'latin-1'
     strict: bool = False
     as_string: bool = True
+    codecs: typing.Tuple[str, ...] = DEFAULT_CODECS
 
     def _is_encoded(self, value):
-        if self.as_string:
-            return isinstance(value, str) and str(value)[:3] in ('b"\\', "b'\\")
-        return isinstance(value, bytes) and value[:1] == b'\x80'
+        if isinstance(value, str):
+            return len(value) > 0 and ord(value[0]) in TAGS
+        return isinstance(value, (bytes, bytearray, memoryview)) and get_codec(value) is not None
 
     def encode(self, value):
-        """Encode a value to a string.
-        Note were using the str instead of encoding to bytes because it works best with
-        numbers too without creating issues with different encodings.
-        """
-        encoded = cloudpickle.dumps(value)
+        """Encode a value to bytes, or to a string if `as_string`"""
+        encoded = to_tagged(value, self.codecs)
         if self.as_string:
-            return str(encoded)
+            return encoded.decode(self.encoding)
         return encoded
 
+    @staticmethod
+    def _legacy_decode(value):
+        """Values written by older versions as cloudpickle bytes or their string representation"""
+        if isinstance(value, bytes):
+            if value[:1] == b'\x80':
+                return cloudpickle.loads(value)
+            if value[:3] in (b'b"\\', b"b'\\"):
+                value = value.decode()
+        if isinstance(value, str) and value[:3] in ('b"\\', "b'\\"):
+            return cloudpickle.loads(ast.literal_eval(value))
+        return value
+
+    def _from_transport(self, value: bytes) -> bytes:
+        """
+        Strings of an `as_string` store come back as their utf-8 bytes from some backends (a raw redis client),
+        so they are mapped back to the `encoding` bytes they were made of
+        """
+        try:
+            mapped = value.decode('utf-8').encode(self.encoding)
+        except (UnicodeDecodeError, UnicodeEncodeError):  # not a string we wrote
+            return value
+        return mapped if self._is_encoded(mapped) else value
+
     def decode(self, value):
         if value is not None:
+            if self.as_string and isinstance(value, (bytes, bytearray)):
+                value = self._from_transport(bytes(value))
             if self._is_encoded(value):
-                if self.as_string:
-                    value = eval(value)
-                value = cloudpickle.loads(value)
-                return value
-            return value
+                if isinstance(value, str):
+                    value = value.encode(self.encoding)
+                return from_tagged(value)
+            return self._legacy_decode(value)
 
     def encode_key(self, key):
         if self.strict:
@@ -203,13 +230,12 @@ class KeyValueStore(Strict):
         self._flush()
 
         def decode_key(key):
-            if key is not None:
-                if isinstance(key, str) and str(key)[:3] in ('b"\\', "b'\\"):
-                    return cloudpickle.loads(eval(key))
-                return key
+            if isinstance(key, str) and key[:3] in ('b"\\', "b'\\"):
+                return self.decode(ast.literal_eval(key))
+            return key
 
         for key, value in mapper.items():
-            self[decode_key(key)] = cloudpickle.loads(value)
+            self[decode_key(key)] = self.decode(value)
         return self
 
     def reload(self, other):
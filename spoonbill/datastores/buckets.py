@@ -1,7 +1,13 @@
+import fnmatch
+import json
+import os
 import pathlib
 import shutil
+import time
+import uuid
 from spoonbill.datastores.base import KeyValueStore, VALUE
-from spoonbill.datastores.utils import is_cloud_url
+from spoonbill.filesystem import FileSystem, ReadCache
+from spoonbill.datastores.utils import is_cloud_url, LAYOUT_FILE, fanout_prefix, resolve_fanout, layout_content
 
 
 class BucketStore(KeyValueStore):
@@ -9,27 +15,44 @@ class BucketStore(KeyValueStore):
     A dictionary implemented as a bucket of files.
     Pros: cloud persistent, cheap.
     Cons: slow.
+
+    A write is a single PUT - the size is counted from one listing of the bucket when `len` is called.
+    With `fanout`, keys are spread over nested directories from a hash of the key (`ab/cd/key` for 2 levels).
+    The layout is recorded in a marker file, so the store is reopened with the same layout.
+    Reads of a cloud bucket go through `cache` (or the default `ReadCache`) if there is one.
     """
-    COUNT_KEY = f"count__count__count"
+    COUNT_KEY = f"count__count__count"  # the size file of older versions, ignored
 
-    def __init__(self, path):
+    def __init__(self, path, fanout: int = None, cache: ReadCache = None):
         self.path = path
         self.bucket = self.get_pathlib(path)
         self.strict = False
+        self.fanout = 0
+        self.filesystem = FileSystem(path, cache=cache) if is_cloud_url(path) else None
         self._create_table()
+        self._set_layout(fanout)
 
-    @property
-    def _size_file(self):
-        return self._to_key(self.COUNT_KEY)
+    def _set_layout(self, fanout: int = None):
+        layout_file = self.bucket.joinpath(LAYOUT_FILE)
+        layout = layout_file.read_bytes() if layout_file.is_file() else None
+        fanout = resolve_fanout(layout, fanout)
+        if fanout and layout is None:
+            if next(self._list_files(), None) is not None:
+                raise ValueError(f"{self.path} has keys in a flat layout, it can't be opened with a fanout")
+            layout_file.write_bytes(layout_content(fanout))
+        self.fanout = fanout
 
     def _create_table(self):
         self.bucket.mkdir(parents=True, exist_ok=True)
-        if not self._size_file.is_file():
-            self._to_key(self.COUNT_KEY).write_text('0')
 
     @classmethod
-    def open(self, path: str):
-        return BucketStore(path)
+    def open(self, path: str, fanout: int = None, cache: ReadCache = None):
+        return BucketStore(path, fanout=fanout, cache=cache)
+
+    def _read_text(self, file) -> str:
+        if self.filesystem is not None and self.filesystem.cache is not None:
+            return self.filesystem.read_file(str(file)).decode('utf-8')
+        return file.read_text()
 
     @staticmethod
     def get_pathlib(path):
@@ -39,34 +62,48 @@ class BucketStore(KeyValueStore):
         return pathlib.Path(path)
 
     def _to_key(self, key):
-        return self.bucket.joinpath(str(key))
+        key = str(key)
+        if self.fanout:
+            return self.bucket.joinpath(fanout_prefix(key, self.fanout), key)
+        return self.bucket.joinpath(key)
+
+    def _scan(self, directory: str, depth: int):
+        """The names of the local files `depth` directories down, with one os.scandir per directory"""
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if depth:
+                    if entry.is_dir():
+                        yield from self._scan(entry.path, depth - 1)
+                elif entry.is_file() and (self.fanout or entry.name not in (self.COUNT_KEY, LAYOUT_FILE)):
+                    yield entry.name
+
+    def _list_files(self):
+        """The names of the files in the bucket from a single listing, with no request per file"""
+        if isinstance(self.bucket, pathlib.Path):
+            yield from self._scan(str(self.bucket), self.fanout)
+            return
+        for root, _, files in self.bucket.walk():
+            if len(root.relative_to(self.bucket).parts) == self.fanout:
+                for name in files:
+                    if self.fanout or name not in (self.COUNT_KEY, LAYOUT_FILE):
+                        yield name
+            if not self.fanout:
+                break
 
     def __len__(self):
-        if self._size_file.is_file():
-            return int(self._size_file.read_text())
-        return 0
+        return sum(1 for _ in self._list_files())
 
     def _get_item(self, key):
         file = self._to_key(key)
         if file.is_file():
-            return self.decode_value(file.read_text())
+            return self.decode_value(self._read_text(file))
         return None
 
-    def _increment(self):
-        file = self._size_file
-        count = int(file.read_text()) if file.is_file() else 0
-        file.write_text(str(count + 1))
-
-    def _decrement(self):
-        file = self._size_file
-        count = int(file.read_text()) if file.is_file() else 0
-        file.write_text(str(max(count - 1, 0)))
-
     def _put_item(self, key, value):
         file = self._to_key(key)
-        if not file.is_file():
-            self._increment()
-        self._to_key(key).write_text(self.encode_value(value))
+        if self.fanout and isinstance(file, pathlib.Path):
+            file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_text(self.encode_value(value))
 
     def __getitem__(self, key):
         value = self._get_item(key)
@@ -85,30 +122,27 @@ class BucketStore(KeyValueStore):
         if not file.is_file():
             raise KeyError(key)
         file.unlink()
-        self._decrement()
 
     def get(self, key, default=None):
         file = self._to_key(key)
         if file.is_file():
-            return self.decode_value(file.read_text())
+            return self.decode_value(self._read_text(file))
         return default
 
     def set(self, key, value):
         self._put_item(key, value)
 
     def _iter_keys(self, pattern: str = None, limit: int = None):
-        iterator = self.bucket.glob(
-            pattern) if pattern is not None else self.bucket.iterdir()
-        for i, key in enumerate(iterator):
+        names = self._list_files()
+        if pattern is not None:
+            names = fnmatch.filter(names, pattern)
+        for i, name in enumerate(names):
             if i == limit:
                 break
-            if key.name == self.COUNT_KEY:
-                continue
-            if key.is_file():
-                yield key
+            yield self._to_key(name)
 
     def _to_key_value(self, key):
-        return self.decode_key(key.name), self.decode_value(key.read_text())
+        return self.decode_key(key.name), self.decode_value(self._read_text(key))
 
     def keys(self, pattern: str = None, limit: int = None):
         for key in self._iter_keys(pattern, limit):
@@ -130,7 +164,7 @@ class BucketStore(KeyValueStore):
         if keys is None:
             keys = self._iter_keys(limit=limit)
         for key in keys:
-            yield self.decode_value(self._to_key(key).read_text())
+            yield self.decode_value(self._read_text(self._to_key(key)))
 
     def __contains__(self, item):
         return self._to_key(item).is_file()
@@ -139,19 +173,21 @@ class BucketStore(KeyValueStore):
         count = len(self)
         if isinstance(self.bucket, pathlib.Path):
             for file in self.bucket.iterdir():
-                if file.is_file():
+                if file.is_dir():
+                    shutil.rmtree(file, ignore_errors=True)
+                elif file.name != LAYOUT_FILE:
                     file.unlink()
-            shutil.rmtree(self.bucket.name, ignore_errors=True)
         else:
             self.bucket.rmtree()
+            if self.fanout:
+                self.bucket.joinpath(LAYOUT_FILE).write_bytes(layout_content(self.fanout))
         return count
 
     def pop(self, key, default=None):
         file = self._to_key(key)
         if file.is_file():
-            value = self.decode_value(file.read_text())
+            value = self.decode_value(self._read_text(file))
             file.unlink()
-            self._size_file.write_text(str(max(len(self) - 1, 0)))
             return value
         return default
 
@@ -165,3 +201,254 @@ class BucketStore(KeyValueStore):
         for key, value in d.items():
             self._put_item(key, value)
         return self
+
+
+class PackedBucketStore(KeyValueStore):
+    """
+    A bucket of packed segment files for many small values - a request per segment instead of per key.
+    Writes are buffered and written as one immutable segment (`<name>.seg`) with a sidecar index (`<name>.idx`)
+    once `segment_size` bytes are pending, or on `flush`/`close`.
+    Reads are a ranged GET of the value's bytes in its segment. A newer segment overrides an older one,
+    and deletes are tombstones in the index.
+    `refresh` picks up segments written by other writers, and `compact` rewrites the live values into new segments -
+    run it while the other writers are idle.
+    Segments never change, so with a `ReadCache` (given or the default), whole segments are cached locally.
+    """
+    SEGMENT = '.seg'
+    INDEX = '.idx'
+
+    def __init__(self, path: str, segment_size: int = 2 ** 22, cache: ReadCache = None, **kwargs):
+        self.path = path.rstrip('/')
+        self.strict = False
+        self.as_string = False
+        self.segment_size = segment_size
+        self.filesystem = FileSystem(path, cache=cache, **kwargs)
+        self.fs = self.filesystem.fs
+        self.fs.makedirs(self.path, exist_ok=True)
+        self._indexes = {}  # segment name -> its index
+        self._index = {}  # key -> (segment name, offset, length)
+        self._pending = {}  # key -> bytes, or None for a delete
+        self._pending_size = 0
+        self.refresh()
+
+    @classmethod
+    def open(cls, path: str, segment_size: int = 2 ** 22, cache: ReadCache = None, **kwargs):
+        return PackedBucketStore(path, segment_size=segment_size, cache=cache, **kwargs)
+
+    def _path(self, name: str, suffix: str) -> str:
+        return f"{self.path}/{name}{suffix}"
+
+    @staticmethod
+    def _new_name() -> str:
+        # names sort by the time they were written, so a newer segment is applied last
+        return f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+
+    def refresh(self):
+        """Reload the indexes of the segments in the bucket"""
+        names = sorted(file.rsplit('/', 1)[-1][:-len(self.INDEX)]
+                       for file in self.fs.glob(self._path('*', self.INDEX)))
+        for name in names:
+            if name not in self._indexes:
+                self._indexes[name] = json.loads(self.fs.cat_file(self._path(name, self.INDEX)))
+        self._indexes = {name: self._indexes[name] for name in names}
+        self._index = {}
+        for name, index in self._indexes.items():
+            for key, (offset, length) in index['keys'].items():
+                self._index[key] = (name, offset, length)
+            for key in index['deleted']:
+                self._index.pop(key, None)
+        return self
+
+    def _write_segment(self, name: str, records: dict):
+        data, keys, deleted, offset = [], {}, [], 0
+        for key, value in records.items():
+            if value is None:
+                deleted.append(key)
+                continue
+            data.append(value)
+            keys[key] = (offset, len(value))
+            offset += len(value)
+        index = {'keys': keys, 'deleted': deleted}
+        self.fs.pipe_file(self._path(name, self.SEGMENT), b''.join(data))
+        self.fs.pipe_file(self._path(name, self.INDEX), json.dumps(index).encode())  # visible once the index exists
+        self._indexes[name] = index
+        for key, (offset, length) in keys.items():
+            self._index[key] = (name, offset, length)
+        for key in deleted:
+            self._index.pop(key, None)
+
+    def flush(self):
+        """Write the pending changes as a new segment, returns the number of changes"""
+        count = len(self._pending)
+        if count:
+            self._write_segment(self._new_name(), self._pending)
+            self._pending = {}
+            self._pending_size = 0
+        return count
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _put(self, key, value):
+        self._pending[key] = value
+        self._pending_size += len(value) if value is not None else 0
+        if self._pending_size >= self.segment_size:
+            self.flush()
+
+    def _read(self, key):
+        if key in self._pending:
+            return self._pending[key]
+        if key in self._index:
+            name, offset, length = self._index[key]
+            if self.filesystem.cache is not None:
+                return self.filesystem.read_file(self._path(name, self.SEGMENT))[offset:offset + length]
+            return self.fs.cat_file(self._path(name, self.SEGMENT), start=offset, end=offset + length)
+        return None
+
+    def _live_keys(self):
+        for key in self._index:
+            if key not in self._pending:
+                yield key
+        for key, value in self._pending.items():
+            if value is not None:
+                yield key
+
+    def _iter_items(self, limit: int = None):
+        """Each segment is read once, instead of a request per key"""
+        count = 0
+        for key, value in self._pending.items():
+            if value is not None:
+                if count == limit:
+                    return
+                count += 1
+                yield key, value
+        segments = {}
+        for key, (name, offset, length) in self._index.items():
+            if key not in self._pending:
+                segments.setdefault(name, []).append((key, offset, length))
+        for name, records in segments.items():
+            data = self.filesystem.read_file(self._path(name, self.SEGMENT))
+            for key, offset, length in records:
+                if count == limit:
+                    return
+                count += 1
+                yield key, data[offset:offset + length]
+
+    def encode_key(self, key):
+        return str(key)
+
+    def decode_key(self, key):
+        return key
+
+    def __len__(self):
+        return sum(1 for _ in self._live_keys())
+
+    def __contains__(self, item):
+        key = self.encode_key(item)
+        if key in self._pending:
+            return self._pending[key] is not None
+        return key in self._index
+
+    def __getitem__(self, key):
+        value = self._read(self.encode_key(key))
+        if value is None:
+            raise KeyError(key)
+        return self.decode_value(value)
+
+    def __setitem__(self, key, value):
+        self._put(self.encode_key(key), self.encode_value(value))
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def get(self, key, default=None):
+        value = self._read(self.encode_key(key))
+        if value is None:
+            return default
+        return self.decode_value(value)
+
+    def set(self, key, value):
+        self[key] = value
+        return True
+
+    def delete(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._put(self.encode_key(key), None)
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        if key in self:
+            self.delete(key)
+        return value
+
+    def popitem(self):
+        key = next(self._live_keys())
+        value = self[key]
+        self.delete(key)
+        return key, value
+
+    def update(self, d):
+        for key, value in d.items():
+            self[key] = value
+        return self
+
+    def keys(self, pattern: str = None, limit: int = None):
+        keys = self._live_keys()
+        if pattern is not None:
+            keys = (key for key in keys if fnmatch.fnmatch(key, pattern))
+        for i, key in enumerate(keys):
+            if i == limit:
+                break
+            yield key
+
+    def values(self, keys: list = None, limit: int = None):
+        if keys is not None:
+            for key in keys:
+                yield self[key]
+            return
+        for _, value in self._iter_items(limit):
+            yield self.decode_value(value)
+
+    def items(self, conditions: dict = None, limit: int = None):
+        if conditions is not None and not hasattr(conditions, 'items'):
+            conditions = {VALUE: conditions}
+        for key, value in self._scan_match(self._iter_items(), conditions=conditions, limit=limit):
+            yield key, value
+
+    def compact(self):
+        """Rewrite the live values into new segments and remove the old ones, returns the number of segments removed"""
+        self.flush()
+        self.refresh()
+        old = list(self._indexes)
+        if not old:
+            return 0
+        records, size, part = {}, 0, 0
+        for key, value in self._iter_items():
+            records[key] = value
+            size += len(value)
+            if size >= self.segment_size:
+                self._write_segment(f"{old[-1]}-{part:04d}", records)  # sorts after the segments it replaces
+                records, size, part = {}, 0, part + 1
+        if records:
+            self._write_segment(f"{old[-1]}-{part:04d}", records)
+        for name in old:
+            self.fs.rm([self._path(name, self.INDEX), self._path(name, self.SEGMENT)])
+            del self._indexes[name]
+        return len(old)
+
+    def _flush(self):
+        count = len(self)
+        self._pending = {}
+        self._pending_size = 0
+        for name in list(self._indexes):
+            self.fs.rm([self._path(name, self.INDEX), self._path(name, self.SEGMENT)])
+        self._indexes = {}
+        self._index = {}
+        return count
@@ -0,0 +1,197 @@
+import contextlib
+import math
+import pickle
+import struct
+import typing
+
+import cloudpickle
+
+PICKLE_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+UNSUPPORTED = (TypeError, ValueError, OverflowError, AttributeError, pickle.PicklingError)
+
+
+class Codec:
+    """
+    A serializer identified by a one-byte tag.
+    The tag is written as the first byte of every payload, so decoding is a single lookup.
+    `dumps` raises one of `UNSUPPORTED` if the value can't be round-tripped exactly, so the next codec is tried.
+    """
+    name: str = None
+    tag: bytes = None
+
+    def dumps(self, value) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    """bytes are stored as-is."""
+    name = 'raw'
+    tag = b'\x01'
+
+    def dumps(self, value) -> bytes:
+        if type(value) is not bytes:
+            raise TypeError(f"{type(value)} is not bytes")
+        return value
+
+    def loads(self, data):
+        return bytes(data)
+
+
+class PickleCodec(Codec):
+    """Standard pickle with protocol 5 - Much faster than cloudpickle for plain data."""
+    name = 'pickle'
+    tag = b'\x02'
+
+    def dumps(self, value) -> bytes:
+        encoded = pickle.dumps(value, protocol=PICKLE_PROTOCOL)
+        if b'__main__' in encoded:
+            # objects from __main__ are pickled by reference and can't be loaded elsewhere, cloudpickle saves them by value
+            raise pickle.PicklingError("__main__ objects are left to cloudpickle")
+        return encoded
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """msgpack for plain data types. Requires `pip install msgpack`"""
+    name = 'msgpack'
+    tag = b'\x03'
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, value) -> bytes:
+        # strict_types rejects tuples and subclasses which would not come back as the same type
+        return self.msgpack.packb(value, use_bin_type=True, strict_types=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+class OrjsonCodec(Codec):
+    """orjson for json data types. Requires `pip install orjson`"""
+    name = 'orjson'
+    tag = b'\x04'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    @classmethod
+    def _is_json(cls, value) -> bool:
+        kind = type(value)
+        if kind in (str, int, bool) or value is None:
+            return True
+        if kind is float:
+            return math.isfinite(value)
+        if kind is list:
+            return all(cls._is_json(item) for item in value)
+        if kind is dict:
+            return all(type(key) is str and cls._is_json(item) for key, item in value.items())
+        return False
+
+    def dumps(self, value) -> bytes:
+        if not self._is_json(value):
+            raise TypeError(f"{type(value)} is not json serializable without loss")
+        return self.orjson.dumps(value)
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+
+class CloudpickleCodec(Codec):
+    """The fallback - anything which is cloudpickle-able"""
+    name = 'cloudpickle'
+    tag = b'\x05'
+
+    def dumps(self, value) -> bytes:
+        return cloudpickle.dumps(value, protocol=PICKLE_PROTOCOL)
+
+    def loads(self, data):
+        return cloudpickle.loads(data)
+
+
+class NumpyCodec(Codec):
+    """
+    numpy arrays as a dtype and shape header followed by the raw data.
+    Loading is a read-only view on the given buffer with no copy.
+    """
+    name = 'numpy'
+    tag = b'\x06'
+
+    def dumps(self, value) -> bytes:
+        kind = type(value)
+        if kind.__name__ != 'ndarray' or kind.__module__ != 'numpy':
+            raise TypeError(f"{kind} is not a numpy array")
+        if value.dtype.hasobject or value.dtype.fields is not None:
+            raise TypeError(f"{value.dtype} has no fixed raw layout")
+        dtype = value.dtype.str.encode()
+        header = struct.pack('<B', len(dtype)) + dtype + struct.pack(f'<B{value.ndim}q', value.ndim, *value.shape)
+        return header + value.tobytes(order='C')
+
+    def loads(self, data):
+        import numpy
+        data = memoryview(data)
+        size = data[0]
+        dtype = bytes(data[1:1 + size]).decode()
+        ndim = data[1 + size]
+        offset = 2 + size
+        shape = struct.unpack_from(f'<{ndim}q', data, offset)
+        offset += 8 * ndim
+        return numpy.frombuffer(data, dtype=dtype, offset=offset).reshape(shape)
+
+
+CODECS: typing.Dict[str, Codec] = {}
+TAGS: typing.Dict[int, Codec] = {}
+DEFAULT_CODECS = ('raw', 'pickle', 'cloudpickle')
+
+
+def register_codec(codec: Codec):
+    if codec.tag is None or len(codec.tag) != 1:
+        raise ValueError(f"codec {codec.name} must have a one-byte tag")
+    if codec.tag[0] in TAGS and TAGS[codec.tag[0]].name != codec.name:
+        raise ValueError(f"tag {codec.tag} is already used by {TAGS[codec.tag[0]].name}")
+    CODECS[codec.name] = codec
+    TAGS[codec.tag[0]] = codec
+    return codec
+
+
+register_codec(RawCodec())
+register_codec(PickleCodec())
+register_codec(CloudpickleCodec())
+register_codec(NumpyCodec())
+with contextlib.suppress(ImportError):
+    register_codec(MsgpackCodec())
+with contextlib.suppress(ImportError):
+    register_codec(OrjsonCodec())
+
+
+def to_tagged(value, codecs: typing.Sequence[str] = DEFAULT_CODECS) -> bytes:
+    """Serialize with the first codec in `codecs` which supports the value, prefixed by its tag."""
+    for name in codecs[:-1]:
+        codec = CODECS.get(name)
+        if codec is None:
+            continue
+        with contextlib.suppress(*UNSUPPORTED):
+            return codec.tag + codec.dumps(value)
+    codec = CODECS[codecs[-1]]
+    return codec.tag + codec.dumps(value)
+
+
+def get_codec(data) -> typing.Optional[Codec]:
+    """Returns the codec which encoded the data (bytes-like), or None if it is not tagged"""
+    if len(data) == 0:
+        return None
+    return TAGS.get(data[0])
+
+
+def from_tagged(data):
+    codec = get_codec(data)
+    if codec is None:
+        raise ValueError("data is not encoded by a known codec")
+    return codec.loads(memoryview(data)[1:])
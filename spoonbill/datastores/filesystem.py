@@ -1,6 +1,9 @@
-from spoonbill.datastores.base import KeyValueStore
+from spoonbill.datastores.base import KeyValueStore, KEY, VALUE
 from spoonbill.datastores.inmemory import InMemoryStore
+from spoonbill.datastores.utils import LAYOUT_FILE, fanout_prefix, resolve_fanout, layout_content
+from spoonbill.filesystem import FileSystem, ReadCache, DEFAULT_CONCURRENCY
 
+import itertools
 import fsspec
 
 import cloudpickle
@@ -11,13 +14,39 @@ class FilesystemStore(KeyValueStore):
     A dictionary implemented as map from file name as key to file contents as value.
     Pros: cloud persistent, cheap.
     Cons: slow.
+
+    With `fanout`, keys are spread over nested directories from a hash of the key (`ab/cd/key` for 2 levels).
+    The layout is recorded in a marker file, so the store is reopened with the same layout.
+
+    `get_many`, `set_many`, `values(keys)` and `update` read and write `concurrency` files at a time.
+    Reads of a remote store go through `cache` (or the default `ReadCache`) if there is one.
     """
+    BATCH_SIZE = 1000
 
-    def __init__(self, path, **kwargs):
+    def __init__(self, path, fanout: int = None, concurrency: int = DEFAULT_CONCURRENCY, cache: ReadCache = None,
+                 **kwargs):
         self._store = fsspec.get_mapper(path, **kwargs)
+        self.filesystem = FileSystem(path, cache=cache, **kwargs)
+        self.concurrency = concurrency
         self.store_path = path
         self.strict = False
         self.as_string = False
+        self.fanout = 0
+        self._set_layout(fanout)
+
+    def _set_layout(self, fanout: int = None):
+        layout = self._store.get(LAYOUT_FILE)
+        fanout = resolve_fanout(layout, fanout)
+        if fanout and layout is None:
+            if next(iter(self._store.keys()), None) is not None:
+                raise ValueError(f"{self.store_path} has keys in a flat layout, it can't be opened with a fanout")
+            self._store[LAYOUT_FILE] = layout_content(fanout)
+        self.fanout = fanout
+
+    def _store_keys(self):
+        for key in self._store.keys():
+            if key != LAYOUT_FILE:
+                yield key
 
     def encode_value(self, value):
         return cloudpickle.dumps(value)
@@ -26,32 +55,102 @@ class FilesystemStore(KeyValueStore):
         return cloudpickle.loads(value)
 
     def encode_key(self, key):
+        if self.fanout:
+            return f"{fanout_prefix(str(key), self.fanout)}/{key}"
         return key
 
     def decode_key(self, key):
+        if self.fanout:
+            return key.split('/', self.fanout)[-1]
         return key
 
     @classmethod
-    def open(self, path: str, **kwargs):
-        return FilesystemStore(path, **kwargs)
+    def open(self, path: str, fanout: int = None, concurrency: int = DEFAULT_CONCURRENCY, cache: ReadCache = None,
+             **kwargs):
+        return FilesystemStore(path, fanout=fanout, concurrency=concurrency, cache=cache, **kwargs)
+
+    def __getitem__(self, item):
+        if self.filesystem.cache is None:
+            return super().__getitem__(item)
+        try:
+            return self.decode_value(self.filesystem.read_file(self._store._key_to_str(self.encode_key(item))))
+        except FileNotFoundError:
+            raise KeyError(item)
+
+    def get(self, key, default=None):
+        if self.filesystem.cache is None:
+            return super().get(key, default)
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        if self.fanout:
+            return sum(1 for _ in self._store_keys())
+        return len(self._store)
+
+    def keys(self, pattern: str = None, limit: int = None, *args, **kwargs):
+        is_valid = self._to_filter(KEY, pattern) if pattern else lambda x: True
+        for i, key in enumerate(self._store_keys()):
+            if i == limit:
+                break
+            key = self.decode_key(key)
+            if is_valid(key):
+                yield key
+
+    def items(self, conditions: dict = None, limit: int = None):
+        if conditions is not None and not hasattr(conditions, 'items'):
+            conditions = {VALUE: conditions}
+        items = ((key, self._store[key]) for key in self._store_keys())
+        for key, value in self._scan_match(items, conditions, limit):
+            yield key, value
 
     def _flush(self):
-        for key in self.keys():
+        count = len(self)
+        for key in list(self._store_keys()):
             del self._store[key]
+        return count
 
     def set(self, key, value):
         self[key] = value
         return True
 
-    def values(self, keys=None):
-        if keys is None:
-            keys = self.keys()
-        for key in keys:
-            yield self[key]
+    def get_many(self, keys) -> dict:
+        """Read many keys concurrently, returns {key: value} without the missing keys"""
+        paths = {self._store._key_to_str(self.encode_key(key)): key for key in keys}
+        found = self.filesystem.get_many(list(paths), concurrency=self.concurrency)
+        return {paths[path]: self.decode_value(data) for path, data in found.items()}
+
+    def set_many(self, d: dict):
+        """Write many keys concurrently"""
+        self.filesystem.set_many({self._store._key_to_str(self.encode_key(key)): self.encode_value(value)
+                                  for key, value in d.items()}, concurrency=self.concurrency)
+        return True
+
+    def values(self, keys=None, default=None):
+        keys = iter(self.keys() if keys is None else keys)
+        while True:
+            batch = list(itertools.islice(keys, self.BATCH_SIZE))
+            if not batch:
+                break
+            found = self.get_many(batch)
+            for key in batch:
+                yield found.get(key, default)
+
+    def update(self, d):
+        self.set_many(d)
+        return self
+
+    def pop(self, key, default=None):
+        key = self.encode_key(key)
+        if key not in self._store:
+            return default
+        return self.decode_value(self._store.pop(key))
 
     def popitem(self):
-        item = self._store.popitem()
-        return self.decode_value(item[1])
+        key = next(self._store_keys())
+        return self.decode_value(self._store.pop(key))
 
     def save(self, path, **kwargs):
         target_path = fsspec.get_mapper(path, **kwargs)
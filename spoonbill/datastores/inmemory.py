@@ -51,7 +51,3 @@ class InMemoryStore(KeyValueStore):
         :return:
         """
         return InMemoryStore(store=path, strict=strict)
-
-    @staticmethod
-    def _is_encoded(value):
-        return str(value)[:2] == "b'"
@@ -1,71 +1,510 @@
 from spoonbill.datastores.base import ContextStore
 from typing import Any, Dict, Optional
-from spoonbill.datastores.utils import get_pathlib
+from spoonbill.datastores.utils import get_pathlib, is_cloud_url
+from collections.abc import MutableMapping
+import contextlib
+import threading
+import zlib
 import json
+import os
+import pathlib
+
+# a log smaller than this is never compacted automatically
+MIN_COMPACT_SIZE = 2 ** 20
+# the contexts of stores are opened lazily, once
+_context_lock = threading.Lock()
+
+
+class TrackedDict(dict):
+    """A dict which remembers if it was changed, so an unchanged file is not written again"""
+    dirty = False
+
+    def _changed(method):
+        def wrapper(self, *args, **kwargs):
+            self.dirty = True
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    __setitem__ = _changed(dict.__setitem__)
+    __delitem__ = _changed(dict.__delitem__)
+    pop = _changed(dict.pop)
+    popitem = _changed(dict.popitem)
+    setdefault = _changed(dict.setdefault)
+    update = _changed(dict.update)
+    clear = _changed(dict.clear)
+    del _changed
 
 
 class JSONContextManager:
+    """
+    Reads the json file on enter and writes it on exit if it was changed.
+    With `cache=True` the parsed data is kept and only read again when the file's mtime, size or inode changed -
+    values are then shared with the cache, so copy them before changing them in-place.
+    Local files are written to a temporary file and renamed, so a reader never sees a partial file.
+    """
+
     def __init__(self, path: str,
                  use_jsonpickle: bool = False,
-                 lookfile_path: Optional[str] = None):
+                 lookfile_path: Optional[str] = None,
+                 use_orjson: bool = False,
+                 indent: Optional[int] = 4,
+                 cache: bool = False):
         self.path = get_pathlib(path)
         self.json = json
         self.lock = None
+        self.indent = indent
+        self.use_orjson = use_orjson
+        if use_jsonpickle and use_orjson:
+            raise ValueError("use_jsonpickle and use_orjson can't be used together")
         if use_jsonpickle:
             import jsonpickle
             self.json = jsonpickle
+        if use_orjson:
+            import orjson
+            self.json = orjson
         if lookfile_path:
             from filelock import FileLock
             self.lock = FileLock(lookfile_path)
+        self.cache = cache
+        self.data = None
+        self._stamp = None
+        self._thread_lock = threading.RLock()  # the data is shared, so a thread holds it from enter to exit
         if not self.path.exists() or self.path.stat().st_size == 0:
             self.path.write_text(json.dumps({}))
 
+    def _get_stamp(self):
+        stat = self.path.stat()
+        return getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size, getattr(stat, 'st_ino', None)
+
+    def _dumps(self, data) -> str:
+        if self.use_orjson:
+            option = self.json.OPT_NON_STR_KEYS | (self.json.OPT_INDENT_2 if self.indent else 0)
+            return self.json.dumps(data, option=option).decode()
+        if self.indent is None:
+            return self.json.dumps(data, separators=(',', ':'))
+        return self.json.dumps(data, indent=self.indent)
+
     def _read(self) -> Dict[Any, Any]:
-        self.data: Dict[Any, Any] = self.json.loads(self.path.read_text())
+        if not self.path.exists():
+            self.path.write_text(json.dumps({}))
+        stamp = self._get_stamp()
+        if not self.cache or self.data is None or stamp != self._stamp:
+            self.data = TrackedDict(self.json.loads(self.path.read_text()))
+            self._stamp = stamp
+        self.data.dirty = False
         return self.data
 
     def _write(self):
-        self.path.write_text(self.json.dumps(self.data, indent=4))
+        if not self.data.dirty:
+            return
+        text = self._dumps(self.data)
+        if isinstance(self.path, pathlib.Path):
+            temp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            temp_path.write_text(text)
+            os.replace(temp_path, self.path)
+        else:
+            self.path.write_text(text)  # object stores replace a whole object atomically
+        self.data.dirty = False
+        self._stamp = self._get_stamp()
 
     def __enter__(self):  # type: ignore
-        if self.lock is not None:
-            with self.lock:
-                return self._read()
-        return self._read()
+        self._thread_lock.acquire()
+        try:
+            if self.lock is not None:
+                with self.lock:
+                    return self._read()
+            return self._read()
+        except BaseException:
+            self._thread_lock.release()
+            raise
 
     def __exit__(self, exc_type, exc_val, exc_tb):  # type: ignore
-        if self.lock is not None:
-            with self.lock:
-                return self._write()
-        return self._write()
+        try:
+            if self.lock is not None:
+                with self.lock:
+                    return self._write()
+            return self._write()
+        finally:
+            self._thread_lock.release()
+
+
+class JsonShards(MutableMapping):
+    """
+    Keys are hash-partitioned across `shards` json files in a directory, each with its own `JSONContextManager` and lock.
+    A write only rewrites its shard, and writers to different shards don't wait for each other.
+    """
+
+    def __init__(self, path: str, shards: int,
+                 lookfile_path: Optional[str] = None,
+                 **kwargs):
+        self.path = get_pathlib(path)
+        if isinstance(self.path, pathlib.Path):
+            self.path.mkdir(parents=True, exist_ok=True)
+        self.managers = [JSONContextManager(str(self.path / f"shard-{i:04d}.json"),
+                                            lookfile_path=f"{lookfile_path}.{i}" if lookfile_path else None,
+                                            **kwargs)
+                         for i in range(shards)]
+
+    def _shard(self, key) -> int:
+        # json keys are strings, so 1 and '1' are the same key and must be in the same shard
+        return zlib.crc32(str(key).encode('utf-8')) % len(self.managers)
+
+    def _manager(self, key) -> JSONContextManager:
+        return self.managers[self._shard(key)]
+
+    def __getitem__(self, key):
+        with self._manager(key) as data:
+            return data[key]
+
+    def __setitem__(self, key, value):
+        with self._manager(key) as data:
+            data[key] = value
+
+    def __delitem__(self, key):
+        with self._manager(key) as data:
+            del data[key]
+
+    def __contains__(self, key):
+        with self._manager(key) as data:
+            return key in data
+
+    def __iter__(self):
+        for manager in self.managers:
+            with manager as data:
+                keys = list(data)
+            yield from keys
+
+    def __len__(self):
+        count = 0
+        for manager in self.managers:
+            with manager as data:
+                count += len(data)
+        return count
+
+    def items(self):
+        for manager in self.managers:
+            with manager as data:
+                items = list(data.items())
+            yield from items
+
+    def pop(self, key, default=None):
+        with self._manager(key) as data:
+            if key in data:
+                return data.pop(key)
+        return default
+
+    def update(self, other=(), **kwargs):
+        groups = {}
+        for key, value in dict(other, **kwargs).items():
+            groups.setdefault(self._shard(key), {})[key] = value
+        for shard, values in groups.items():  # a single write per shard
+            with self.managers[shard] as data:
+                data.update(values)
+
+    def clear(self):
+        for manager in self.managers:
+            with manager as data:
+                data.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class JsonLog(MutableMapping):
+    """
+    An append-only json-lines file with an in-memory index of key -> (offset, length).
+    Every line is a record `[key, value]`, or a tombstone `[key]` for a deleted key.
+    The index is built once, a write is a single append and a read is a single seek.
+    When the stale records are more than `compact_ratio` of the file, it is rewritten with the live records only.
+    """
+
+    def __init__(self, path: str,
+                 use_jsonpickle: bool = False,
+                 lookfile_path: Optional[str] = None,
+                 compact_ratio: float = 0.5):
+        if is_cloud_url(path):
+            raise ValueError("The log mode requires a local path")
+        self.path = path
+        self.json = json
+        self.lock = None
+        if use_jsonpickle:
+            import jsonpickle
+            self.json = jsonpickle
+        if lookfile_path:
+            from filelock import FileLock
+            self.lock = FileLock(lookfile_path)
+        self.compact_ratio = compact_ratio
+        self._thread_lock = threading.RLock()
+        self._file = None
+        self._open()
+
+    @property
+    def _locked(self):
+        return self.lock if self.lock is not None else contextlib.nullcontext()
+
+    def _open(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'a+b')
+        self.index: Dict[Any, tuple] = {}
+        self.end = 0
+        self.stale = 0
+        self._replay()
+
+    def _replay(self):
+        """Index the records written after `self.end` - all of them on open, or the ones appended by others"""
+        self._file.seek(self.end)
+        for line in self._file:
+            if not line.endswith(b'\n'):
+                break  # a partial write, ignored and truncated on the next append
+            try:
+                record = self.json.loads(line)
+            except ValueError:
+                break
+            previous = self.index.pop(record[0], None)
+            if previous is not None:
+                self.stale += previous[1]
+            if len(record) == 2:
+                self.index[record[0]] = (self.end, len(line))
+            else:
+                self.stale += len(line)
+            self.end += len(line)
+
+    def _refresh(self):
+        """Catch up with changes by other processes - a compaction replaces the file, an append grows it"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self._open()
+        if stat.st_ino != os.fstat(self._file.fileno()).st_ino or stat.st_size < self.end:
+            self._open()
+        elif stat.st_size > self.end:
+            self._replay()
+
+    def _read(self, key):
+        offset, length = self.index[key]
+        self._file.seek(offset)
+        return self.json.loads(self._file.read(length))[1]
+
+    def _append(self, records: list):
+        lines = [(record[0], len(record) == 2, (self.json.dumps(record) + '\n').encode()) for record in records]
+        with self._locked:
+            self._refresh()
+            if os.fstat(self._file.fileno()).st_size > self.end:
+                self._file.truncate(self.end)  # a partial write of a crashed writer
+            self._file.write(b''.join(line for _, _, line in lines))
+            self._file.flush()
+            for key, live, line in lines:
+                previous = self.index.pop(key, None)
+                if previous is not None:
+                    self.stale += previous[1]
+                if live:
+                    self.index[key] = (self.end, len(line))
+                else:
+                    self.stale += len(line)
+                self.end += len(line)
+            if self.end > MIN_COMPACT_SIZE and self.stale > self.compact_ratio * self.end:
+                self._compact()
+
+    def _compact(self):
+        temp_path = self.path + '.compact'
+        with open(temp_path, 'wb') as file:
+            for key, (offset, length) in sorted(self.index.items(), key=lambda item: item[1][0]):
+                self._file.seek(offset)
+                file.write(self._file.read(length))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        self.end = 0
+        self._open()
+
+    def compact(self):
+        """Rewrite the file with the live records only"""
+        with self._thread_lock, self._locked:
+            self._refresh()
+            before = self.end
+            self._compact()
+            return before - self.end
+
+    def __getitem__(self, key):
+        with self._thread_lock:
+            self._refresh()
+            return self._read(key)
+
+    def __setitem__(self, key, value):
+        with self._thread_lock:
+            self._append([[key, value]])
+
+    def __delitem__(self, key):
+        with self._thread_lock:
+            self._refresh()
+            if key not in self.index:
+                raise KeyError(key)
+            self._append([[key]])
+
+    def __contains__(self, key):
+        with self._thread_lock:
+            self._refresh()
+            return key in self.index
+
+    def __iter__(self):
+        with self._thread_lock:
+            self._refresh()
+            keys = list(self.index)
+        return iter(keys)
+
+    def __len__(self):
+        with self._thread_lock:
+            self._refresh()
+            return len(self.index)
+
+    def items(self):
+        with self._thread_lock:
+            self._refresh()
+            positions = sorted(self.index.values())
+        for offset, length in positions:  # sequential reads
+            with self._thread_lock:
+                self._file.seek(offset)
+                record = self.json.loads(self._file.read(length))
+            yield record[0], record[1]
+
+    def update(self, other=(), **kwargs):
+        with self._thread_lock:
+            self._append([[key, value] for key, value in dict(other, **kwargs).items()])
+
+    def clear(self):
+        with self._thread_lock, self._locked:
+            self._file.truncate(0)
+            self.end = 0
+            self._open()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
 
 
 class JsonStore(ContextStore):
-    """Naive implenetation using json files."""
+    """
+    Naive implenetation using json files.
+    With `log=True` the file is an append-only json-lines log instead - see `JsonLog`.
+    With `shards` the path is a directory of json files, and keys are hash-partitioned between them - see `JsonShards`.
+    With `cache=True` the parsed file is kept between calls - see `JSONContextManager`.
+    """
+    _log = None
+    _shards = None
+    _manager = None
 
     def __init__(self, path: str,
                  strict: bool = False,
                  use_jsonpickle: bool = False,
-                 lockfile_path: Optional[str] = None):
+                 lockfile_path: Optional[str] = None,
+                 log: bool = False,
+                 compact_ratio: float = 0.5,
+                 use_orjson: bool = False,
+                 indent: Optional[int] = 4,
+                 cache: bool = False,
+                 shards: Optional[int] = None):
+        if log and shards:
+            raise ValueError("log and shards can't be used together")
         self.path = path
         self.strict = strict
         self.use_jsonpickle = use_jsonpickle
         self.lockfile_path = lockfile_path
+        self.log = log
+        self.compact_ratio = compact_ratio
+        self.use_orjson = use_orjson
+        self.indent = indent
+        self.cache = cache
+        self.shards = shards
 
     def _flush(self):
+        count = len(self)
         with self.context as data:
             data.clear()
+        return count
 
     @classmethod
     def open(cls, path: str, strict: bool = False,
              use_jsonpickle: bool = False,
-             lockfile_path: Optional[str] = None):
+             lockfile_path: Optional[str] = None,
+             log: bool = False,
+             compact_ratio: float = 0.5,
+             use_orjson: bool = False,
+             indent: Optional[int] = 4,
+             cache: bool = False,
+             shards: Optional[int] = None):
         return JsonStore(path, strict=strict,
                          use_jsonpickle=use_jsonpickle,
-                         lockfile_path=lockfile_path)
+                         lockfile_path=lockfile_path,
+                         log=log,
+                         compact_ratio=compact_ratio,
+                         use_orjson=use_orjson,
+                         indent=indent,
+                         cache=cache,
+                         shards=shards)
 
     @property
     def context(self):
-        return JSONContextManager(self.path,
-                                  use_jsonpickle=self.use_jsonpickle,
-                                  lookfile_path=self.lockfile_path)
+        context = self._opened_context()
+        if context is None:
+            with _context_lock:  # threads share one context
+                context = self._opened_context()
+                if context is None:
+                    context = self._open_context()
+        return context
+
+    def _opened_context(self):
+        for context in (self._log, self._shards, self._manager):
+            if context is not None:
+                return context
+        return None
+
+    def _open_context(self):
+        if self.log:  # the index is built once
+            self._log = JsonLog(self.path,
+                                use_jsonpickle=self.use_jsonpickle,
+                                lookfile_path=self.lockfile_path,
+                                compact_ratio=self.compact_ratio)
+            return self._log
+        if self.shards:
+            self._shards = JsonShards(self.path, self.shards,
+                                      use_jsonpickle=self.use_jsonpickle,
+                                      lookfile_path=self.lockfile_path,
+                                      use_orjson=self.use_orjson,
+                                      indent=self.indent,
+                                      cache=self.cache)
+            return self._shards
+        # kept for its parsed cache, with `cache`
+        self._manager = JSONContextManager(self.path,
+                                           use_jsonpickle=self.use_jsonpickle,
+                                           lookfile_path=self.lockfile_path,
+                                           use_orjson=self.use_orjson,
+                                           indent=self.indent,
+                                           cache=self.cache)
+        return self._manager
+
+    def compact(self):
+        """Removes the overwritten and deleted records from the log, returns the bytes saved"""
+        return self.context.compact()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_log', None)
+        state.pop('_manager', None)
+        state.pop('_shards', None)
+        return state
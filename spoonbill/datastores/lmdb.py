@@ -1,3 +1,15 @@
+import contextlib
+import heapq
+import logging
+import os
+import struct
+import sys
+import tempfile
+import threading
+import typing
+from collections.abc import Mapping
+
+import lmdb
 import lmdbm
 import cloudpickle
 from lmdbm.lmdbm import remove_lmdbm
@@ -5,7 +17,241 @@ from spoonbill.datastores.base import ContextStore
 from spoonbill.filesystem import FileSystem
 
 
-class CloudpickleEncoder(lmdbm.Lmdb):
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+_RECORD_HEADER = struct.Struct('<II')
+# The map is a reservation of address space, the file only grows with the data - except on Windows
+DEFAULT_MAP_SIZE = 2 ** 20 if sys.platform == 'win32' else 2 ** 30
+DEFAULT_GROWTH_FACTOR = 2.0
+DEFAULT_MAX_DBS = 128
+
+
+def _write_run(pairs: list):
+    """Spill a sorted run of (key, value) bytes to a temporary file"""
+    file = tempfile.TemporaryFile()
+    for key, value in pairs:
+        file.write(_RECORD_HEADER.pack(len(key), len(value)))
+        file.write(key)
+        file.write(value)
+    file.seek(0)
+    return file
+
+
+def _read_run(file):
+    with file:
+        while True:
+            header = file.read(_RECORD_HEADER.size)
+            if not header:
+                break
+            key_size, value_size = _RECORD_HEADER.unpack(header)
+            yield file.read(key_size), file.read(value_size)
+
+
+def _sort_pairs(pairs: typing.Iterable, run_size: int):
+    """
+    Sort (key, value) bytes by key - An external merge sort when there are more than `run_size` pairs.
+    Returns the sorted pairs and their total size in bytes.
+    """
+    runs, run, nbytes = [], [], 0
+    for key, value in pairs:
+        run.append((key, value))
+        nbytes += len(key) + len(value)
+        if len(run) == run_size:
+            run.sort(key=lambda pair: pair[0])
+            runs.append(_write_run(run))
+            run = []
+    run.sort(key=lambda pair: pair[0])
+    if not runs:
+        return iter(run), nbytes
+    if run:
+        runs.append(_write_run(run))
+    # merge is stable, so the last of equal keys is the latest value
+    return heapq.merge(*[_read_run(file) for file in runs], key=lambda pair: pair[0]), nbytes
+
+
+# LMDB environments must not be opened twice in one process, so stores on the same path share one
+# path -> [environment, users, open options]
+_environments: typing.Dict[str, list] = {}
+_environments_lock = threading.Lock()
+
+
+def acquire_environment(path: str, flag: str = "c", mode: int = 0o755, map_size: int = DEFAULT_MAP_SIZE,
+                        max_dbs: int = DEFAULT_MAX_DBS, **kwargs) -> lmdb.Environment:
+    """
+    Open the environment at `path`, or return the one already open in this process.
+    `flag`: r (read only, existing), w (read and write, existing),
+            c (read, write, create if not exists), n (read, write, overwrite existing)
+    An environment already open with other options (read only, lock, max_dbs, ...) raises a ValueError.
+    `map_size` is the minimum, an open environment with a smaller map is grown to it.
+    """
+    if flag not in ('r', 'w', 'c', 'n'):
+        raise ValueError("Invalid flag")
+    key = os.path.abspath(path)
+    options = dict(kwargs, readonly=flag == 'r', max_dbs=max_dbs)
+    with _environments_lock:
+        if key in _environments:
+            env, users, opened = _environments[key]
+            if flag == 'n':
+                raise ValueError(f"{path} is open by another store, it can't be overwritten")
+            if opened != options:
+                raise ValueError(f"{path} is already open with {opened}, not {options}")
+            if not options['readonly'] and map_size > env.info()['map_size']:
+                env.set_mapsize(map_size)
+            _environments[key][1] += 1
+            return env
+        if flag == 'n':
+            remove_lmdbm(path)
+        env = lmdb.open(path, map_size=map_size, max_dbs=max_dbs, readonly=flag == 'r', create=flag in ('c', 'n'),
+                        mode=mode, **kwargs)
+        _environments[key] = [env, 1, options]
+        return env
+
+
+def environment_users(path: str) -> int:
+    """The number of open stores which use the environment at `path` in this process"""
+    with _environments_lock:
+        entry = _environments.get(os.path.abspath(path))
+        return entry[1] if entry is not None else 0
+
+
+def _close_inherited_environments():
+    """
+    A forked child must not use the environments of its parent, it opens its own.
+    Closing them in the child only unmaps the child's copy - LMDB's locks are per process, so the parent keeps them.
+    The registry lock is recreated, it may have been held by another thread of the parent at the fork.
+    """
+    global _environments_lock
+    _environments_lock = threading.Lock()
+    for env, _, _ in _environments.values():
+        env.close()
+    _environments.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_close_inherited_environments)
+
+
+def release_environment(env: lmdb.Environment):
+    """Close the environment when its last store is closed"""
+    with _environments_lock:
+        for key, (opened, users, _) in _environments.items():
+            if opened is env:
+                if users > 1:
+                    _environments[key][1] -= 1
+                    return
+                del _environments[key]
+                break
+    env.close()
+
+
+class DatabaseEnvironment:
+    """An environment whose transactions default to one named database, so lmdbm's methods work on it as-is"""
+
+    def __init__(self, env: lmdb.Environment, db):
+        self.env = env
+        self.db = db
+
+    def begin(self, **kwargs):
+        kwargs.setdefault('db', self.db)
+        return self.env.begin(**kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self.env, item)
+
+
+class BytesEncoder(lmdbm.Lmdb):
+    """
+    Stores bytes as-is and strings as utf-8, so keys keep LMDB's native ordering.
+    When the map is full it grows geometrically by `growth_factor`, or enough to fit the write.
+    With a `name`, it is a named database in the environment which other named databases share.
+    """
+    growth_factor: float = DEFAULT_GROWTH_FACTOR
+    dbi = None
+
+    @classmethod
+    def open(cls, file: str, flag: str = "c", mode: int = 0o755, map_size: int = DEFAULT_MAP_SIZE,
+             autogrow: bool = True, name: str = None, max_dbs: int = DEFAULT_MAX_DBS, **kwargs):
+        env = acquire_environment(file, flag=flag, mode=mode, map_size=map_size, max_dbs=max_dbs, **kwargs)
+        if name is None:
+            return cls(env, autogrow)
+        try:
+            dbi = env.open_db(name.encode('utf-8'), create=flag != 'r')
+        except Exception:
+            release_environment(env)
+            raise
+        encoder = cls(DatabaseEnvironment(env, dbi), autogrow)
+        encoder.dbi = dbi
+        return encoder
+
+    @property
+    def environment(self) -> lmdb.Environment:
+        return self.env.env if self.dbi is not None else self.env
+
+    def close(self):
+        release_environment(self.environment)
+
+    def drop(self):
+        """Delete all the keys of the database - the named one, or the main one"""
+        with self.env.begin(write=True) as txn:
+            txn.drop(self.dbi if self.dbi is not None else self.env.open_db(), delete=False)
+
+    def used_bytes(self) -> int:
+        return (self.env.info()['last_pgno'] + 1) * self.env.stat()['psize']
+
+    def grow(self, nbytes: int = 0):
+        """Grow the map by `growth_factor`, and at least to fit `nbytes` more - LMDB's overhead can double small records"""
+        map_size = max(int(self.env.info()['map_size'] * self.growth_factor), self.used_bytes() + 2 * nbytes)
+        self.env.set_mapsize(map_size)
+        logger.info(self.autogrow_msg, self.env.path(), map_size)
+
+    def reserve(self, nbytes: int):
+        """Grow ahead of a write of about `nbytes`, instead of failing and retrying it"""
+        if self.autogrow and self.used_bytes() + 2 * nbytes > self.env.info()['map_size']:
+            self.grow(nbytes)
+
+    def putmulti(self, pairs: list, append: bool = False) -> int:
+        """Write encoded pairs in one transaction, growing the map when it is full"""
+        while True:
+            try:
+                with self.env.begin(write=True) as txn:
+                    _, added = txn.cursor().putmulti(pairs, dupdata=False, overwrite=True, append=append)
+                return added
+            except lmdb.MapFullError:
+                if not self.autogrow:
+                    raise
+                self.grow(sum(len(key) + len(value) for key, value in pairs))
+
+    def __setitem__(self, key, value):
+        self.putmulti([(self._pre_key(key), self._pre_value(value))])
+
+    def update(self, other=(), **kwargs):
+        if isinstance(other, Mapping):
+            other = other.items()
+        pairs = [(self._pre_key(key), self._pre_value(value)) for key, value in other]
+        pairs.extend((self._pre_key(key), self._pre_value(value)) for key, value in kwargs.items())
+        self.reserve(sum(len(key) + len(value) for key, value in pairs))
+        self.putmulti(pairs)
+
+    def _pre_key(self, value):
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        return value
+
+    def _pre_value(self, value):
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        return value
+
+    def get(self, key, default=None):
+        with self.env.begin() as txn:  # py-lmdb recycles read transactions, so this is a reset/renew
+            value = txn.get(self._pre_key(key))
+        if value is None:
+            return default
+        return self._post_value(value)
+
+
+class CloudpickleEncoder(BytesEncoder):
     @staticmethod
     def encode(value):
         return cloudpickle.dumps(value)
@@ -28,6 +274,89 @@ class CloudpickleEncoder(lmdbm.Lmdb):
         return self.decode(value)
 
 
+class LmdbReader:
+    """
+    A read transaction on an LmdbStore.
+    With `buffers=True`, values are decoded from buffers backed by the memory map without a copy - for example
+    raw bytes in strict raw mode or arrays stored with the `numpy` codec.
+    Those values are only valid inside the `with` block.
+    """
+
+    def __init__(self, store, buffers: bool = True, txn: lmdb.Transaction = None):
+        self.store = store
+        self.buffers = buffers
+        self.txn = txn
+        self.dbi = store.db.dbi
+
+    def __enter__(self):
+        self.txn = self.store.db.env.begin(buffers=self.buffers)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.txn.abort()
+        self.txn = None
+
+    def _encode_key(self, key):
+        return self.store.db._pre_key(self.store.encode_key(key))
+
+    def _get(self, key):
+        return self.txn.get(self._encode_key(key), db=self.dbi)
+
+    def _decode(self, value):
+        return self.store.decode_value(self.store.db._post_value(value))
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is None:
+            raise KeyError(key)
+        return self._decode(value)
+
+    def __contains__(self, key):
+        return self._get(key) is not None
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        if value is None:
+            return default
+        return self._decode(value)
+
+    def values(self, keys: list = None, limit: int = None, default=None):
+        if keys is None:
+            iterator = self.txn.cursor(db=self.dbi).iternext(keys=False, values=True)
+        else:
+            iterator = (self._get(key) for key in keys)
+        for i, value in enumerate(iterator):
+            if i == limit:
+                break
+            yield default if value is None else self._decode(value)
+
+
+class LmdbWriter(LmdbReader):
+    """A store's view of a write transaction, see `LmdbStore.transaction`"""
+
+    def __setitem__(self, key, value):
+        self.txn.put(self._encode_key(key), self.store.db._pre_value(self.store.encode_value(value)), db=self.dbi)
+
+    def set(self, key, value):
+        self[key] = value
+        return True
+
+    def __delitem__(self, key):
+        if not self.txn.delete(self._encode_key(key), db=self.dbi):
+            raise KeyError(key)
+
+    def pop(self, key, default=None):
+        value = self.txn.pop(self._encode_key(key), db=self.dbi)
+        if value is None:
+            return default
+        return self._decode(value)
+
+    def update(self, d):
+        for key, value in d.items():
+            self[key] = value
+        return self
+
+
 class LmdbStore(ContextStore):
     """
     An LMDB key-value store based on [lmdb-python-dbm](https://github.com/Dobatymo/lmdb-python-dbm).
@@ -37,26 +366,183 @@ class LmdbStore(ContextStore):
     It uses the existing lower level Python bindings [py-lmdb](https://lmdb.readthedocs.io/en/release/).
     This is especially useful on Windows, where otherwise dbm.dumb is the default dbm database.
 
+    Use `reader` to read many values in one transaction, zero-copy with `buffers=True`.
+    Store numpy arrays with `codecs=('raw', 'numpy', 'pickle', 'cloudpickle')` to read them as views on the memory map.
+
+    With a `name`, the store is a named database in the environment at `path`, which it shares with the other named
+    stores there. Use `transaction` to read and write a few of them atomically.
+
+    Stores can be shared with forked or spawned worker processes, each process opens its own environment.
+    For an immutable snapshot, `flag='r', lock=False` skips LMDB's locking so readers scale with processes.
+
+    With `raw=True` nothing is pickled by the backend:
+    * strict - keys and values are bytes (strings are stored as utf-8), as LMDB does natively.
+    * not strict - values are encoded once by the store codecs, string keys are stored as utf-8 and sorted natively.
     """
     manager = CloudpickleEncoder
+    raw: bool = False
+    growth_factor: float = DEFAULT_GROWTH_FACTOR
+    _db = None
+    _pid = None
 
-    def __init__(self, path: str, flag: str = "c", mode: int = 0o755, map_size: int = 2 ** 20, autogrow: bool = True,
-                 strict=True):
+    def __init__(self, path: str, flag: str = "c", mode: int = 0o755, map_size: int = DEFAULT_MAP_SIZE,
+                 autogrow: bool = True, strict=True, raw: bool = False, codecs: tuple = None,
+                 growth_factor: float = DEFAULT_GROWTH_FACTOR, name: str = None, max_dbs: int = DEFAULT_MAX_DBS,
+                 lock: bool = True):
         self.store_path = path
+        self.name = name
+        self.growth_factor = growth_factor
         self.strict = strict
         self.as_string = False
-        self.open_params = {"flag": flag, "mode": mode,
-                            "map_size": map_size, "autogrow": autogrow}
+        self.raw = raw
+        if codecs is not None:
+            self.codecs = codecs
+        if raw:
+            self.manager = BytesEncoder
+        self.open_params = {"flag": flag, "mode": mode, "map_size": map_size, "autogrow": autogrow,
+                            "name": name, "max_dbs": max_dbs, "lock": lock}
+
+    @property
+    def db(self):
+        """
+        The environment is opened once per process and kept open until `close`.
+        After a fork, or when the store is pickled to another process, it is reopened there on first use.
+        """
+        if self._db is not None and self._pid != os.getpid():
+            self._db = None  # the parent's handle was closed in the forked child
+        if self._db is None:
+            self._db = self.manager.open(self.store_path, **self.open_params)
+            self._db.growth_factor = self.growth_factor
+            self._pid = os.getpid()
+            if self.open_params.get("flag") == "n":
+                self.open_params["flag"] = "c"  # reopening must not overwrite the data again
+        return self._db
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        return state
 
     @property
     def context(self):
-        return CloudpickleEncoder.open(self.store_path, **self.open_params)
+        return contextlib.nullcontext(self.db)
+
+    def close(self):
+        if self._db is not None:
+            if self._pid == os.getpid():
+                self._db.close()
+            self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def _flush(self):
         count = len(self)
+        if self.name is not None or environment_users(self.store_path) > 1:
+            self.db.drop()  # the files can't be removed under stores which still use them
+            return count
+        self.close()
         remove_lmdbm(self.store_path)
         return count
 
+    @contextlib.contextmanager
+    def transaction(self, *others: 'LmdbStore', write: bool = True):
+        """
+        One transaction over this store and other named stores in the same environment.
+        Yields a view per store, which is committed together on exit, or aborted on an exception.
+        with users.transaction(orders) as (users_txn, orders_txn):
+            users_txn['user'] = {'orders': 1}
+            orders_txn['order'] = {'user': 'user'}
+        """
+        stores = (self,) + others
+        env = self.db.environment
+        if any(store.db.environment is not env for store in others):
+            raise ValueError("A transaction can only span stores in the same environment")
+        view = LmdbWriter if write else LmdbReader
+        with env.begin(write=write) as txn:
+            views = tuple(view(store, buffers=False, txn=txn) for store in stores)
+            yield views if others else views[0]
+
+    def get(self, key, default=None):
+        value = self.db.get(self.encode_key(key), _MISSING)
+        if value is _MISSING:
+            return default
+        return self.decode_value(value)
+
+    def _encode_pairs(self, iterable):
+        db = self.db
+        if isinstance(iterable, Mapping):
+            iterable = iterable.items()
+        for key, value in iterable:
+            yield db._pre_key(self.encode_key(key)), db._pre_value(self.encode_value(value))
+
+    def _put_sorted(self, batch: list, last_key: typing.Optional[bytes]) -> int:
+        """Writes a sorted batch, appending when it is after every existing key"""
+        return self.db.putmulti(batch, append=last_key is None or batch[0][0] > last_key)
+
+    def bulk_load(self, iterable, presorted: bool = False, batch_size: int = 100000, run_size: int = 1000000):
+        """
+        Load many key-values much faster than `update`.
+        The encoded pairs are sorted by key (with an external merge sort above `run_size` pairs), and written in
+        transactions of `batch_size` using LMDB's append mode whenever the keys come after the existing keys.
+        :param iterable: a dict or an iterable of (key, value)
+        :param presorted: set True if the keys are already sorted by their encoded bytes to skip sorting
+        :return: number of pairs written
+        """
+        pairs = self._encode_pairs(iterable)
+        if not presorted:
+            pairs, nbytes = _sort_pairs(pairs, run_size)
+            self.db.reserve(nbytes)
+        with self.db.env.begin() as txn:
+            cursor = txn.cursor()
+            last_key = bytes(cursor.key()) if cursor.last() else None
+
+        count, batch, batch_bytes = 0, [], 0
+        for key, value in pairs:
+            if batch and batch[-1][0] >= key:
+                if batch[-1][0] > key:
+                    raise ValueError("bulk_load with presorted=True got keys out of order")
+                batch[-1] = (key, value)
+                continue
+            if len(batch) == batch_size:
+                if presorted:
+                    self.db.reserve(batch_bytes)
+                count += self._put_sorted(batch, last_key)
+                last_key = max(batch[-1][0], last_key or b'')
+                batch, batch_bytes = [], 0
+            batch.append((key, value))
+            batch_bytes += len(key) + len(value)
+        if batch:
+            if presorted:
+                self.db.reserve(batch_bytes)
+            count += self._put_sorted(batch, last_key)
+        return count
+
+    def reader(self, buffers: bool = True):
+        return LmdbReader(self, buffers=buffers)
+
+    def values(self, keys: list = None, limit: int = None, default=None):
+        if keys:
+            with self.reader(buffers=False) as reader:
+                for value in reader.values(keys, limit=limit, default=default):
+                    yield value
+        else:
+            for value in super().values(limit=limit):
+                yield value
+
+    def encode_key(self, key):
+        if self.raw and not self.strict and isinstance(key, str) and not self._is_encoded(key):
+            return key
+        return super().encode_key(key)
+
+    def decode_key(self, key):
+        if self.raw and not self.strict and not self._is_encoded(key):
+            return bytes(key).decode('utf-8')
+        return super().decode_key(key)
+
     @property
     def map_size(self):
         return self.open_params.get("map_size")
@@ -65,16 +551,30 @@ class LmdbStore(ContextStore):
     def autogrow(self):
         return self.open_params.get("autogrow")
 
+    def usage(self) -> dict:
+        """The current map size versus the bytes used by the data"""
+        db = self.db
+        map_size, used = db.map_size, db.used_bytes()
+        return {'map_size': map_size, 'used': used, 'free': map_size - used, 'ratio': used / map_size,
+                'entries': len(db)}
+
     @classmethod
-    def open(cls, db_path, flag: str = "c", mode: int = 0o755, map_size: int = 2 ** 20, autogrow: bool = True,
-             strict=True):
+    def open(cls, db_path, flag: str = "c", mode: int = 0o755, map_size: int = DEFAULT_MAP_SIZE, autogrow: bool = True,
+             strict=True, raw: bool = False, codecs: tuple = None, growth_factor: float = DEFAULT_GROWTH_FACTOR,
+             name: str = None, max_dbs: int = DEFAULT_MAX_DBS, lock: bool = True):
         return LmdbStore(
             path=db_path,
             flag=flag,
             mode=mode,
             map_size=map_size,
             autogrow=autogrow,
-            strict=strict
+            strict=strict,
+            raw=raw,
+            codecs=codecs,
+            growth_factor=growth_factor,
+            name=name,
+            max_dbs=max_dbs,
+            lock=lock
         )
 
     def save(self, path):
@@ -82,5 +582,23 @@ class LmdbStore(ContextStore):
         return True
 
     def load(self, path):
-        FileSystem(path).copy_dir(path, self.store_path)
+        self.close()
+        if environment_users(self.store_path) == 0:
+            FileSystem(path).copy_dir(path, self.store_path)
+            return self
+        # other stores use the files, so the data is replaced in a transaction instead of overwriting them
+        with tempfile.TemporaryDirectory() as local_path:
+            FileSystem(path).copy_dir(path, local_path)
+            source = lmdb.open(local_path, readonly=True, lock=False, max_dbs=self.open_params['max_dbs'])
+            try:
+                db = self.db
+                env = db.environment
+                name = self.name.encode('utf-8') if self.name is not None else None
+                source_dbi, target_dbi = source.open_db(name, create=False), db.dbi or env.open_db()
+                db.reserve((source.info()['last_pgno'] + 1) * source.stat()['psize'])
+                with source.begin(db=source_dbi) as source_txn, env.begin(write=True, db=target_dbi) as txn:
+                    txn.drop(target_dbi, delete=False)
+                    txn.cursor().putmulti(source_txn.cursor().iternext(), dupdata=False, overwrite=True)
+            finally:
+                source.close()
         return self
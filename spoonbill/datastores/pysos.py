@@ -1,7 +1,202 @@
+import bisect
+import contextlib
+import io
 import os
+import pickle
+import shutil
+import struct
+import threading
+import time
+import typing
+import zlib
 import pysos
 
 from spoonbill.datastores.base import KeyValueStore
+from spoonbill.filesystem import FileSystem
+
+
+class SnapshotDict(pysos.Dict):
+    """
+    A pysos.Dict which saves its index next to the data file on `close` and `snapshot`, with the data file's size at
+    that time (the high-water mark) and a checksum of the bytes before it.
+    Opening replays only the lines appended after the mark instead of scanning the whole file.
+    If the file's size and mtime are still the ones of the snapshot, only the last `CHECKSUM_TAIL_SIZE` bytes before the
+    mark are verified, so opening after a `close` doesn't read the whole file. Otherwise the whole checksum is verified.
+    Overwriting or deleting a key comments out its old line in place - these offsets and their original first bytes are
+    appended to a `.flips` journal, so the checksum is verified with them undone. Any other change before the mark -
+    by another writer, or a reused free line - fails the checksum or removes the snapshot, falling back to a full scan.
+    """
+    SUFFIX = '.index'
+    FLIPS_SUFFIX = '.flips'
+    VERSION = 3
+    CHECKSUM_CHUNK_SIZE = 2 ** 20
+    CHECKSUM_TAIL_SIZE = 2 ** 16
+    _FLIP = struct.Struct('<Qc')
+
+    def __init__(self, path):
+        self.index_path = str(path) + self.SUFFIX
+        self.flips_path = self.index_path + self.FLIPS_SUFFIX
+        self._mark = None
+        state = self._read_snapshot(path)
+        if state is None:
+            super().__init__(path)
+            return
+        self.path = path
+        self._file = io.open(path, 'r+b')
+        self._offsets = state['offsets']
+        self._free_lines = state['free_lines']
+        self._observers = []
+        self._mark = state['mark']
+        flipped = set(state['flips'])
+        if flipped:
+            self._offsets = {key: offset for key, offset in self._offsets.items() if offset not in flipped}
+        for offset in flipped:
+            self._file.seek(offset)
+            size = len(self._file.readline())
+            if size > 5:
+                bisect.insort(self._free_lines, (size, offset))
+        self._replay(self._mark)
+
+    def _checksum(self, file, mark: int, restore: dict = None, start: int = 0) -> int:
+        """crc32 of the bytes from `start` to the mark, with `restore` (offset -> byte) undoing commented out lines"""
+        restore = restore or {}
+        checksum = 0
+        file.seek(start)
+        while start < mark:
+            chunk = file.read(min(self.CHECKSUM_CHUNK_SIZE, mark - start))
+            if not chunk:
+                break
+            end = start + len(chunk)
+            offsets = [offset for offset in restore if start <= offset < end]
+            if offsets:
+                chunk = bytearray(chunk)
+                for offset in offsets:
+                    if chunk[offset - start:offset - start + 1] != b'#':
+                        return None  # the journal doesn't match the file
+                    chunk[offset - start:offset - start + 1] = restore[offset]
+            checksum = zlib.crc32(chunk, checksum)
+            start = end
+        return checksum
+
+    def _read_flips(self) -> dict:
+        flips = {}
+        with contextlib.suppress(FileNotFoundError):
+            with open(self.flips_path, 'rb') as file:
+                data = file.read()
+            size = self._FLIP.size
+            for start in range(0, len(data) - len(data) % size, size):
+                offset, byte = self._FLIP.unpack_from(data, start)
+                flips.setdefault(offset, byte)  # the first flip keeps the original byte
+        return flips
+
+    def _read_snapshot(self, path):
+        if not os.path.exists(self.index_path) or not os.path.exists(path):
+            return None
+        try:
+            with open(self.index_path, 'rb') as file:
+                state = pickle.load(file)
+            flips = self._read_flips()
+            with open(path, 'rb') as file:
+                mark = state['mark']
+                if state['version'] != self.VERSION or os.fstat(file.fileno()).st_size < mark or \
+                        any(offset >= mark for offset in flips):
+                    return None
+                unchanged = not flips and self._stamp(file) == state['stamp'] and \
+                    self._checksum(file, mark, start=self._tail(mark)) == state['tail']
+                if not unchanged and self._checksum(file, mark, flips) != state['checksum']:
+                    return None
+        except (OSError, EOFError, KeyError, TypeError, struct.error, pickle.UnpicklingError):
+            return None
+        state['flips'] = list(flips)
+        return state
+
+    @staticmethod
+    def _stamp(file) -> tuple:
+        stat = os.fstat(file.fileno())
+        return stat.st_size, stat.st_mtime_ns
+
+    def _tail(self, mark: int) -> int:
+        return max(0, mark - self.CHECKSUM_TAIL_SIZE)
+
+    def _replay(self, offset: int):
+        """Index the lines from offset to the end, like pysos.Dict does for the whole file"""
+        self._file.seek(offset)
+        for line in self._file:
+            if line != b'\n':
+                if line.startswith(b'#'):
+                    if len(line) > 5:
+                        bisect.insort(self._free_lines, (len(line), offset))
+                else:
+                    self._offsets[pysos.parseKey(line)] = offset
+            offset += len(line)
+
+    def _invalidate(self, offset: int):
+        if self._mark is not None and offset < self._mark:
+            for path in (self.index_path, self.flips_path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            self._mark = None
+
+    def _journal_flips(self, offsets: typing.Iterable[int]):
+        """Record the first bytes of lines before the mark, before they are commented out"""
+        if self._mark is None:
+            return
+        records = []
+        for offset in offsets:
+            if offset < self._mark:
+                self._file.seek(offset)
+                records.append(self._FLIP.pack(offset, self._file.read(1)))
+        if records:
+            with open(self.flips_path, 'ab') as file:
+                file.write(b''.join(records))
+
+    def _freeLine(self, offset):
+        self._journal_flips([offset])
+        super()._freeLine(offset)
+
+    def snapshot(self):
+        """Save the index, the next open replays only what was appended after this"""
+        self._file.flush()
+        mark = self._file.seek(0, os.SEEK_END)
+        state = {'version': self.VERSION, 'mark': mark, 'checksum': self._checksum(self._file, mark),
+                 'tail': self._checksum(self._file, mark, start=self._tail(mark)), 'stamp': self._stamp(self._file),
+                 'offsets': self._offsets, 'free_lines': self._free_lines}
+        temp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.index_path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.flips_path)  # the flips are part of the new checksum
+        self._mark = mark
+        return mark
+
+    def _findLine(self, size):
+        found = super()._findLine(size)
+        if found is not None:
+            self._invalidate(found[1])
+        return found
+
+    def clear(self):
+        self._invalidate(0)
+        super().clear()
+
+    def close(self):
+        if not self._file.closed:
+            self.snapshot()
+        super().close()
+
+    def vacuum(self):
+        self._invalidate(0)
+        pysos.Dict.close(self)
+        tmp_file = str(self.path) + ".tmp"
+        with open(self.path, "rb") as in_file:
+            with open(tmp_file, "wb") as out_file:
+                out_file.write(next(in_file))  # start flag
+                for line in in_file:
+                    if not line.startswith(b"#") and line != b"\n":
+                        out_file.write(line)
+        shutil.move(tmp_file, self.path)
+        self.__init__(self.path)
 
 
 class PysosStore(KeyValueStore):
@@ -20,27 +215,138 @@ class PysosStore(KeyValueStore):
     it's safe: even if the machine crashes in the middle of a big write, data will not be corrupted
     it is platform independent, unlike shelve which relies on an underlying dbm implementation, which may vary from system to system
     the data is stored in a plain text format
+
+    `update` writes all items in one buffered append with a single fsync.
+    With `group_commit` (seconds), concurrent `set` calls within the window are written together the same way.
+    With `index_snapshot`, the index is saved on `close` so opening only replays the tail of the file - see `SnapshotDict`.
+    An unchanged file (same size and mtime) is only checked near the snapshot's end, so an in-place change which keeps
+    both is not detected. Otherwise opening reads the whole file once to verify the snapshot, still without parsing it.
     """
 
-    def __init__(self, store: pysos.Dict = None, store_path: str = None, strict: bool = True):
-        self._store = store or {}
+    def __init__(self, store: pysos.Dict = None, store_path: str = None, strict: bool = True,
+                 group_commit: float = None, index_snapshot: bool = True):
+        self.index_snapshot = index_snapshot
+        if isinstance(store, str):  # PysosStore(path)
+            store, store_path = self._open_dict(store), store
+        self._store = store if store is not None else {}
         self.store_path = store_path
         self.strict = strict
         self.as_string = True
+        self.group_commit = group_commit
+        self._write_lock = threading.RLock()
+        self._pending = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_write_lock', None)
+        state.pop('_pending', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._write_lock = threading.RLock()
+        self._pending = None
+
+    def _write_batch(self, items: dict):
+        """
+        Append encoded items with one buffered write and a single fsync.
+        The records are first written as comments and only then marked valid, followed by commenting out the
+        previous versions - like pysos does per item, so a crash never leaves a partial record behind.
+        """
+        store = self._store
+        if not isinstance(store, pysos.Dict):
+            store.update(items)
+            return
+        with self._write_lock:
+            file = store._file
+            lines = []
+            for key, value in items.items():
+                if store._observers:
+                    store._trigger_observers(key, value, store.get(key))
+                line = pysos.json.dumps(key, ensure_ascii=False) + '\t' + pysos.json.dumps(value, ensure_ascii=False)
+                lines.append((line + '\n').encode('UTF-8'))
+            file.seek(0, os.SEEK_END)
+            start = file.tell()
+            file.write(b''.join(b'#' + line[1:] for line in lines))
+            file.flush()
+            offsets = []
+            offset = start
+            for line in lines:  # only the first byte of each record is rewritten to mark it valid
+                offsets.append(offset)
+                file.seek(offset)
+                file.write(line[0:1])
+                offset += len(line)
+            if isinstance(store, SnapshotDict):
+                store._journal_flips(store._offsets[key] for key in items if store._offsets.get(key))
+            for key in items:
+                old_offset = store._offsets.get(key)
+                if old_offset:
+                    file.seek(old_offset)
+                    file.write(b'#')
+                    file.seek(old_offset)
+                    size = len(file.readline())
+                    if size > 5:
+                        bisect.insort(store._free_lines, (size, old_offset))
+            for key, offset in zip(items, offsets):
+                store._offsets[key] = offset
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _group_set(self, key, value):
+        """Concurrent calls within `group_commit` seconds are written together by the first one"""
+        with self._write_lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = {'items': {}, 'done': threading.Event(), 'error': None}
+            batch['items'][key] = value
+        if leader:
+            time.sleep(self.group_commit)
+            with self._write_lock:
+                self._pending = None
+                try:
+                    self._write_batch(batch['items'])
+                except Exception as e:
+                    batch['error'] = e
+            batch['done'].set()
+        else:
+            batch['done'].wait()
+        if batch['error'] is not None:
+            raise batch['error']
+
+    def _open_dict(self, path: str) -> pysos.Dict:
+        return SnapshotDict(path) if self.index_snapshot else pysos.Dict(path)
+
+    def _remove_files(self):
+        index_path = self.store_path + SnapshotDict.SUFFIX
+        for path in (self.store_path, index_path, index_path + SnapshotDict.FLIPS_SUFFIX):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def snapshot(self):
+        """Save the index now, instead of on `close`"""
+        return self._store.snapshot()
+
+    def close(self):
+        if isinstance(self._store, pysos.Dict):
+            self._store.close()
 
     def _flush(self):
         count = len(self)
-        os.remove(self.store_path)
-        self._store = pysos.Dict(self.store_path)
+        self.close()
+        self._remove_files()
+        self._store = self._open_dict(self.store_path)
         return count
 
     def set(self, key, value):
-        self[key] = value
+        if self.group_commit:
+            self._group_set(self.encode_key(key), self.encode_value(value))
+        else:
+            self[key] = value
         return True
 
     def update(self, d):
-        for k, v in d.items():
-            self[k] = v
+        self._write_batch({self.encode_key(key): self.encode_value(value) for key, value in d.items()})
         return self
 
     def pop(self, key, default=None):
@@ -51,6 +357,18 @@ class PysosStore(KeyValueStore):
             ret = self.decode_value(ret)
         return ret
 
+    def save(self, path):
+        FileSystem(path).write_bytes(FileSystem(self.store_path).read_bytes())
+        return path
+
+    def load(self, path):
+        self.close()
+        self._remove_files()
+        FileSystem(self.store_path).write_bytes(FileSystem(path).read_bytes())
+        self._store = self._open_dict(self.store_path)
+        return self
+
     @classmethod
-    def open(cls, path: str, strict: bool = True):
-        return PysosStore(pysos.Dict(path), path, strict=strict)
+    def open(cls, path: str, strict: bool = True, group_commit: float = None, index_snapshot: bool = True):
+        store = SnapshotDict(path) if index_snapshot else pysos.Dict(path)
+        return PysosStore(store, path, strict=strict, group_commit=group_commit, index_snapshot=index_snapshot)
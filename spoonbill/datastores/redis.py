@@ -1,31 +1,237 @@
+import collections
+import itertools
+import threading
 import time
 import typing
 
 import redis
 
-from spoonbill.datastores.base import KeyValueStore, Strict
+from spoonbill.datastores.base import KeyValueStore, Strict, VALUE
 
 REDIS_DEFAULT_HOST = 'localhost'
 REDIS_DEFAULT_PORT = 6379
 REDIS_DEFAULT_DB = 1
+REDIS_PAGE_SIZE = 1000
+REDIS_BATCH_SIZE = 100
+INVALIDATION_CHANNEL = '__redis__:invalidate'
+# Lua scripts for atomic operations in one round trip - KEYS[1] is the key unless stated otherwise
+POPITEM_SCRIPT = """
+local key = redis.call('RANDOMKEY')
+if not key then return nil end
+local kind = redis.call('TYPE', key)['ok']
+local value
+if kind == 'hash' then value = redis.call('HGETALL', key) else value = redis.call('GET', key) end
+redis.call('DEL', key)
+return {key, kind, value}
+"""
+# ARGV is the value, or the field-value pairs of a hash
+SETDEFAULT_SCRIPT = """
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'hash' then return {kind, redis.call('HGETALL', KEYS[1])} end
+if kind ~= 'none' then return {kind, redis.call('GET', KEYS[1])} end
+if #ARGV == 1 then redis.call('SET', KEYS[1], ARGV[1]) else redis.call('HSET', KEYS[1], unpack(ARGV)) end
+return {kind}
+"""
+# ARGV is the new value, and the expected one - no expected value means the key must be missing
+COMPARE_AND_SET_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= (ARGV[2] or false) then return 0 end
+redis.call('SET', KEYS[1], ARGV[1])
+return 1
+"""
+# non-strict counters are kept as a tagged protocol 0 pickle of an int, which Lua can read and write
+COUNTER_FORMAT = '\x02I{}\n.'
+INCREMENT_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+local number = 0
+if current then
+  number = tonumber(string.match(current, '^\\2I(%-?%d+)\\n%.$'))
+  if not number then return redis.error_reply('not a counter') end
+end
+number = number + tonumber(ARGV[1])
+if math.abs(number) >= 2^53 then return redis.error_reply('not a counter') end
+number = string.format('%.0f', number)
+redis.call('SET', KEYS[1], '\\2I' .. number .. '\\n.')
+return number
+"""
+
+
+class TrackingCache:
+    """
+    A bounded LRU of raw redis values, kept coherent with redis client tracking in broadcast mode.
+
+    One connection enables tracking with itself as the redirect target and subscribes to the invalidation channel,
+    so every write to a key - from any client - removes it from the cache.
+    A read which raced with an invalidation is not cached. If the connection is re-established, the cache is cleared
+    since invalidations may have been missed, and if the listener fails the cache is disabled.
+    Keys are cached as the bytes sent to redis, so str and bytes keys match the invalidations of any client.
+    """
+
+    def __init__(self, max_size: int = 10000, prefixes: typing.Sequence[str] = ()):
+        self.max_size = max_size
+        self.prefixes = tuple(prefixes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.active = False
+        self._values = collections.OrderedDict()
+        self._reading = {}  # key -> token of the read in flight, removed when the key is invalidated
+        self._lock = threading.Lock()
+        self._encoder = redis.connection.Encoder('utf-8', 'strict', False)
+        self._pubsub = None
+        self._thread = None
+
+    def listen(self, client):
+        """Start tracking and listening to invalidations on a dedicated connection of the client"""
+        connection = client.connection_pool.get_connection()
+        self._encoder = connection.encoder
+        self._track(connection)
+        connection.register_connect_callback(self._track)
+        self._pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.connection = connection
+        connection.register_connect_callback(self._pubsub.on_connect)
+        self._pubsub.subscribe(**{INVALIDATION_CHANNEL: self._on_message})
+        self._thread = self._pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self._on_error)
+        self.active = True
+        return self
+
+    def _track(self, connection):
+        connection.send_command('CLIENT', 'ID')
+        client_id = connection.read_response()
+        prefixes = [arg for prefix in self.prefixes for arg in ('PREFIX', prefix)]
+        connection.send_command('CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id, 'BCAST', *prefixes)
+        connection.read_response()
+        self.clear()  # anything cached before tracking was on may be stale
+
+    def _key(self, key) -> bytes:
+        return self._encoder.encode(key)
+
+    def _on_message(self, message):
+        keys = message['data']
+        if keys is None or isinstance(keys, (str, bytes)):  # flushdb / flushall
+            self.clear()
+        else:
+            self.invalidate(keys)
+
+    def _on_error(self, error, pubsub, thread):
+        self.active = False
+        self.clear()
+        thread.stop()
+
+    def get(self, key, fetch: typing.Callable):
+        """Returns the cached value of the key, or `fetch(key)` which is cached if the key wasn't changed meanwhile"""
+        cached = self._key(key)
+        with self._lock:
+            if cached in self._values:
+                self.hits += 1
+                self._values.move_to_end(cached)
+                return self._values[cached]
+            self.misses += 1
+            if not self.active:
+                token = None
+            else:
+                token = self._reading[cached] = object()
+        value = None
+        try:
+            value = fetch(key)
+        finally:
+            if token is not None:
+                self._store_read(cached, token, value)
+        return value
+
+    def _store_read(self, key, token, value):
+        with self._lock:
+            if self._reading.get(key) is token:
+                del self._reading[key]
+                if value is not None:
+                    self._values[key] = value
+                    while len(self._values) > self.max_size:
+                        self._values.popitem(last=False)
+                        self.evictions += 1
+
+    def invalidate(self, keys: typing.Iterable):
+        keys = [self._key(key) for key in keys]
+        with self._lock:
+            for key in keys:
+                self.invalidations += 1
+                self._values.pop(key, None)
+                self._reading.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._reading.clear()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'hit_rate': self.hits / requests if requests else 0.0,
+                'size': len(self._values), 'max_size': self.max_size, 'active': self.active}
+
+    def close(self):
+        self.active = False
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread = None
+        if self._pubsub is not None:
+            self._pubsub.connection.deregister_connect_callback(self._track)
+            self._pubsub.close()
+            self._pubsub = None
+        self.clear()
 
 
 class RedisStore(KeyValueStore, Strict):
     """
     Redis Key-value store
+
+    Iteration never uses the blocking KEYS command - keys are streamed with SCAN, `page_size` keys at a time,
+    and the values of each page are fetched with a single MGET.
+
+    With `batch_window`, concurrent get/set/contains calls from different threads are sent together - the first
+    caller waits up to `batch_window` seconds (or until `batch_size` calls were collected) and sends them all in one
+    pipeline, with consecutive gets merged into a single MGET.
+
+    With `cache_size`, get reads through a local LRU of up to `cache_size` values which redis keeps coherent with
+    client tracking invalidations - see `TrackingCache`. Requires redis 6 or later.
+
+    With `hashes`, non-empty dict values are stored as redis hashes with a field per item, so `get_fields` reads only
+    some fields (HMGET), `set_fields` updates only some fields (HSET) and `items` conditions are matched on the
+    condition fields alone, fetching the full values of the matches.
     """
 
-    def __init__(self, store: typing.Any, strict: bool = False):
+    def __init__(self, store: typing.Any, strict: bool = False, page_size: int = REDIS_PAGE_SIZE,
+                 batch_window: float = None, batch_size: int = REDIS_BATCH_SIZE, cache_size: int = None,
+                 cache_prefixes: typing.Sequence[str] = (), hashes: bool = False):
         """
 
         :param store: The redis.Redis client
         :param strict: If False, all keys and values are encoded and decoded using cloudpickle - This make the RedisDict behave like a normal dict
                 If True, all keys and values are encoded and decoded using str as default with redis - This make reading, writing and scaning faster
                 default: False
+        :param page_size: The SCAN count hint and MGET batch size used when iterating
+        :param batch_window: If set, concurrent get/set/contains calls within this many seconds share one round trip
+        :param batch_size: The most calls sent in one batch, a full batch is sent without waiting for the window
+        :param cache_size: If set, the number of values to keep in a client-side cache
+        :param cache_prefixes: Only track and cache keys with these prefixes - default is all keys
+        :param hashes: If True, dict values are stored as redis hashes
         """
         self._store = store
         self.strict = strict
         self.as_string = True
+        self.page_size = page_size
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.hashes = hashes
+        self._batch_lock = threading.Lock()
+        self._pending = None
+        self._scripts = {}
+        self.cache = None
+        if cache_size:
+            self.cache = TrackingCache(cache_size, cache_prefixes).listen(store)
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
 
     def __len__(self):
         return self._store.dbsize()
@@ -50,111 +256,432 @@ class RedisStore(KeyValueStore, Strict):
     def _databases_names(cls, store):
         return list(store.config_get("keyspace").keys())
 
+    def _batched(self, command: str, key, value=None):
+        """Adds the command to the pending batch and returns its result, the first caller of a batch sends it"""
+        with self._batch_lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = {'commands': [], 'results': None, 'full': threading.Event(),
+                                         'done': threading.Event(), 'error': None}
+            index = len(batch['commands'])
+            batch['commands'].append((command, key, value))
+            if len(batch['commands']) >= self.batch_size:
+                self._pending = None  # the next caller starts a new batch
+                batch['full'].set()
+        if leader:
+            batch['full'].wait(self.batch_window)
+            with self._batch_lock:
+                if self._pending is batch:
+                    self._pending = None
+            try:
+                batch['results'] = self._execute_batch(batch['commands'])
+            except Exception as e:
+                batch['error'] = e
+            batch['done'].set()
+        else:
+            batch['done'].wait()
+        if batch['error'] is not None:
+            raise batch['error']
+        result = batch['results'][index]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _execute_batch(self, commands: list) -> list:
+        calls = []  # (command, indexes) in order - consecutive gets are merged into one MGET
+        for index, (command, key, value) in enumerate(commands):
+            if command == 'get' and calls and calls[-1][0] == 'get':
+                calls[-1][1].append(index)
+            else:
+                calls.append((command, [index]))
+        pipeline = self._store.pipeline(transaction=False)
+        for command, indexes in calls:
+            if command == 'get':
+                pipeline.mget([commands[index][1] for index in indexes])
+            elif command == 'set':
+                pipeline.set(*commands[indexes[0]][1:])
+            else:
+                pipeline.exists(commands[indexes[0]][1])
+        results = [None] * len(commands)
+        for (command, indexes), reply in zip(calls, pipeline.execute(raise_on_error=False)):
+            if command == 'get' and not isinstance(reply, Exception):
+                for index, value in zip(indexes, reply):
+                    results[index] = value
+            else:
+                for index in indexes:
+                    results[index] = reply
+        gets = [index for index, (command, key, value) in enumerate(commands) if command == 'get']
+        for index, value in zip(gets, self._read_hashes([commands[index][1] for index in gets],
+                                                        [results[index] for index in gets])):
+            results[index] = value
+        return results
+
+    def _read_hashes(self, keys: list, values: list) -> list:
+        """Replaces the missing MGET values of hash keys with their fields, in one more round trip if there are any"""
+        missing = [index for index, value in enumerate(values) if value is None]
+        if not self.hashes or not missing:
+            return values
+        values = list(values)
+        pipeline = self._store.pipeline(transaction=False)
+        for index in missing:
+            pipeline.hgetall(keys[index])
+        for index, fields in zip(missing, pipeline.execute(raise_on_error=False)):
+            if isinstance(fields, dict) and fields:
+                values[index] = fields
+        return values
+
+    def _read(self, key):
+        """A single value - GET and HGETALL are sent together if there are hashes, one of them fails on the type"""
+        if not self.hashes:
+            return self._store.get(key)
+        pipeline = self._store.pipeline(transaction=False)
+        pipeline.get(key)
+        pipeline.hgetall(key)
+        value, fields = pipeline.execute(raise_on_error=False)
+        if isinstance(fields, dict) and fields:
+            return fields
+        return None if isinstance(value, Exception) else value
+
+    def _encode_value(self, value):
+        if self.hashes and isinstance(value, dict) and value:
+            return {self.encode_key(field): self.encode_value(item) for field, item in value.items()}
+        return self.encode_value(value)
+
+    def decode_value(self, value):
+        decode = super().decode_value
+        if isinstance(value, dict):  # a hash
+            return {self.decode_key(field): decode(item) for field, item in value.items()}
+        return decode(value)
+
+    def _write(self, pipeline, key, value):
+        if self.hashes and isinstance(value, dict):  # replaces whatever the key held with the hash
+            pipeline.delete(key)
+            pipeline.hset(key, mapping=value)
+        else:
+            pipeline.set(key, value)
+
+    def _fetch(self, key):
+        if self.batch_window is None:
+            return self._read(key)
+        return self._batched('get', key)
+
+    def _get(self, key):
+        if self.cache is None:
+            return self._fetch(key)
+        return self.cache.get(key, self._fetch)
+
+    def _set(self, key, value):
+        if self.hashes and isinstance(value, dict):
+            pipeline = self._store.pipeline()
+            self._write(pipeline, key, value)
+            result = bool(pipeline.execute())
+        elif self.batch_window is None:
+            result = self._store.set(key, value)
+        else:
+            result = self._batched('set', key, value)
+        self._invalidate(key)
+        return result
+
+    def _invalidate(self, *keys):
+        """Our own writes are dropped from the cache right away, without waiting for the invalidation message"""
+        if self.cache is not None:
+            self.cache.invalidate(keys)
+
+    def _exists(self, key):
+        if self.batch_window is None:
+            return self._store.exists(key)
+        return self._batched('exists', key)
+
     def __setitem__(self, key, value):
-        self._store[self.encode_key(key)] = self.encode_value(value)
+        self._set(self.encode_key(key), self._encode_value(value))
         return value
 
     def __getitem__(self, item):
-        return self.decode_value(self._store.get(self.encode_key(item)))
+        return self.decode_value(self._get(self.encode_key(item)))
 
     def __contains__(self, item):
-        return bool(self._store.exists(self.encode_key(item)))
+        return bool(self._exists(self.encode_key(item)))
 
     def __delitem__(self, key):
-        return self._store.delete(self.encode_key(key))
+        return self.delete(key)
 
     def pop(self, item, default=None):
+        """GETDEL, or a transaction of GET, HGETALL and DEL if there are hashes - atomic in one round trip"""
         key = self.encode_key(item)
-        value = self.decode_value(self._store.get(key)) or default
-        self._store.delete(key)
-        return value
+        if self.hashes:
+            pipeline = self._store.pipeline()
+            pipeline.get(key)
+            pipeline.hgetall(key)
+            pipeline.delete(key)
+            value, fields, _ = pipeline.execute(raise_on_error=False)
+            value = fields if isinstance(fields, dict) and fields else value
+            value = None if isinstance(value, Exception) else value
+        else:
+            value = self._store.getdel(key)
+        self._invalidate(key)
+        return self.decode_value(value) or default
+
+    def _script(self, script: str):
+        if script not in self._scripts:
+            self._scripts[script] = self._store.register_script(script)
+        return self._scripts[script]
+
+    def _from_script(self, kind: str, value):
+        if kind == 'hash':
+            value = dict(zip(value[::2], value[1::2]))
+        return self.decode_value(value)
+
+    def popitem(self):
+        """Removes and returns a random item, atomically with a Lua script"""
+        item = self._script(POPITEM_SCRIPT)()
+        if item is None:
+            raise KeyError('popitem(): dictionary is empty')
+        key, kind, value = item
+        self._invalidate(key)
+        return self.decode_key(key), self._from_script(kind, value)
+
+    def setdefault(self, key, default=None):
+        """Returns the value of the key, or sets it to `default` if it is missing - atomically with a Lua script"""
+        encoded = self._encode_value(default)
+        if isinstance(encoded, dict):
+            args = [arg for field, item in encoded.items() for arg in (field, item)]
+        else:
+            args = [encoded]
+        result = self._script(SETDEFAULT_SCRIPT)(keys=[self.encode_key(key)], args=args)
+        if len(result) == 1:  # was missing
+            self._invalidate(self.encode_key(key))
+            return default
+        return self._from_script(*result)
+
+    def compare_and_set(self, key, expected, value, missing: bool = False) -> bool:
+        """
+        Sets the value only if the current one is `expected` - or if the key is missing when `missing` is True.
+        Values are compared by their encoding, so it is meant for values stored as one string - not hashes.
+        """
+        args = [self.encode_value(value)] if missing else [self.encode_value(value), self.encode_value(expected)]
+        key = self.encode_key(key)
+        changed = bool(self._script(COMPARE_AND_SET_SCRIPT)(keys=[key], args=args))
+        if changed:
+            self._invalidate(key)
+        return changed
+
+    def increment(self, key, amount: typing.Union[int, float] = 1):
+        """
+        Adds `amount` to a number and returns the result, a missing key counts as 0.
+        strict uses INCRBY / INCRBYFLOAT. Otherwise integer counters are updated with a Lua script, and anything else
+        with an optimistic WATCH transaction.
+        """
+        encoded = self.encode_key(key)
+        try:
+            if self.strict:
+                if isinstance(amount, float):
+                    return self._store.incrbyfloat(encoded, amount)
+                return self._store.incrby(encoded, amount)
+            if isinstance(amount, int):
+                try:
+                    return int(self._script(INCREMENT_SCRIPT)(keys=[encoded], args=[amount]))
+                except redis.exceptions.ResponseError as e:
+                    if 'not a counter' not in str(e):
+                        raise
+
+            def add(pipeline):
+                number = (self.decode_value(pipeline.get(encoded)) or 0) + amount
+                pipeline.multi()
+                counter = type(number) is int
+                pipeline.set(encoded, COUNTER_FORMAT.format(number) if counter else self.encode_value(number))
+                return number
+
+            return self._store.transaction(add, encoded, value_from_callable=True)
+        finally:
+            self._invalidate(encoded)
 
     def get(self, key, default=None):
-        return self.decode_value(self._store.get(self.encode_key(key))) or default
+        return self.decode_value(self._get(self.encode_key(key))) or default
 
     def set(self, key, value):
-        return self._store.set(self.encode_key(key), self.encode_value(value))
+        return self._set(self.encode_key(key), self._encode_value(value))
 
     def update(self, d):
         pipeline = self._store.pipeline()
         for key, value in d.items():
-            pipeline.set(self.encode_key(key), self.encode_value(value))
+            self._write(pipeline, self.encode_key(key), self._encode_value(value))
         pipeline.execute()
+        if self.cache is not None:
+            self.cache.invalidate([self.encode_key(key) for key in d])
         return True
 
+    def get_fields(self, key, fields: typing.Sequence, default=None) -> dict:
+        """Reads only some fields of a dict value - with HMGET if it is a hash"""
+        key = self.encode_key(key)
+        try:
+            values = self._store.hmget(key, [self.encode_key(field) for field in fields])
+        except redis.exceptions.ResponseError:  # not a hash
+            value = self.decode_value(self._store.get(key))
+            value = value if isinstance(value, dict) else {}
+            return {field: value.get(field, default) for field in fields}
+        return {field: default if value is None else self.decode_value(value) for field, value in zip(fields, values)}
+
+    def set_fields(self, key, mapping: dict):
+        """
+        Updates only some fields of a dict value, a missing key starts as an empty dict.
+        With `hashes` it is an HSET, otherwise - or if the dict is stored as one value - an optimistic WATCH transaction.
+        """
+        if not mapping:
+            return True
+        encoded = self.encode_key(key)
+        try:
+            if self.hashes:
+                try:
+                    self._store.hset(encoded, mapping=self._encode_value(dict(mapping)))
+                    return True
+                except redis.exceptions.ResponseError:  # a dict stored as one value
+                    pass
+
+            def merge(pipeline):
+                value = self.decode_value(pipeline.get(encoded))
+                value = {} if value is None else value
+                if not isinstance(value, dict):
+                    raise TypeError(f"{key} is not a dict")
+                value.update(mapping)
+                pipeline.multi()
+                self._write(pipeline, encoded, self._encode_value(value))
+
+            self._store.transaction(merge, encoded)
+            return True
+        finally:
+            self._invalidate(encoded)
+
     def delete(self, key):
-        return self._store.delete(self.encode_key(key))
+        key = self.encode_key(key)
+        result = self._store.delete(key)
+        self._invalidate(key)
+        return result
 
     def pipeline(self):
         return self._store.pipeline()
 
-    def scan(self, pattern: str = None, *args, **kwargs):
-        params = {'count': 1000000}
-        if pattern:
-            params['match'] = pattern
-        if len(self) > 0:
-            cursor = '0'
-            while cursor != 0:
-                cursor, keys = self._store.scan(cursor=cursor, **params)
-                values = self._store.mget(*keys)
-                for key, value in zip(keys, values):
-                    if value is None:
-                        continue
-                    yield self.decode_key(key), self.decode_value(value)
-
-    def _items(self, *args, **kwargs):
-        keys = self._store.keys(*args, **kwargs)
-        if keys:
-            values = self._store.mget(*keys)
-            for key, value in zip(keys, values):
-                yield self.decode_key(key), self.decode_value(value)
-        return iter([])
+    def _pages(self, pattern: str = None, limit: int = None, values: bool = False):
+        """
+        Yields pages of keys - or of (key, value) pairs if `values` - as returned from redis, without decoding.
+        The MGET of a page is sent in the same pipeline as the SCAN of the next one, so each page costs one round trip.
+        Stops scanning as soon as `limit` keys were yielded.
+        """
+        if limit is not None and limit <= 0:
+            return
+        params = {'match': pattern, 'count': self.page_size if limit is None else min(self.page_size, limit)}
+        cursor, keys = self._store.scan(cursor=0, **params)
+        while True:
+            if limit is not None:
+                keys = keys[:limit]
+                limit -= len(keys)
+            done = cursor == 0 or limit == 0
+            if values:
+                pipeline = self._store.pipeline(transaction=False)
+                if keys:
+                    pipeline.mget(keys)
+                if not done:
+                    pipeline.scan(cursor=cursor, **params)
+                results = pipeline.execute()
+                if keys:
+                    values = self._read_hashes(keys, results[0])
+                    yield [(key, value) for key, value in zip(keys, values) if value is not None]
+                if not done:
+                    cursor, keys = results[-1]
+            else:
+                if keys:
+                    yield keys
+                if not done:
+                    cursor, keys = self._store.scan(cursor=cursor, **params)
+            if done:
+                return
+
+    def _items(self, pattern: str = None, limit: int = None):
+        for page in self._pages(pattern, limit=limit, values=True):
+            yield from page
+
+    def scan(self, pattern: str = None, limit: int = None, *args, **kwargs):
+        for key, value in self._items(pattern, limit=limit):
+            yield self.decode_key(key), self.decode_value(value)
 
     def keys(self, pattern: str = None, limit: int = None, *args, **kwargs):
-        if pattern:
-            kwargs['pattern'] = pattern
-        for i, key in enumerate(self._store.keys(*args, **kwargs)):
-            if i == limit:
-                break
-            yield self.decode_key(key)
+        for page in self._pages(pattern, limit=limit):
+            for key in page:
+                yield self.decode_key(key)
 
     def values(self, keys: str = None, limit: int = None, default=None, *args, **kwargs):
         if keys:
-            pipeline = self.pipeline()
-            for key in keys:
-                pipeline.get(self.encode_key(key))
-            for value in pipeline.execute():
-                yield self.decode_value(value) if value is not None else default
+            keys = iter(keys)
+            while True:
+                page = [self.encode_key(key) for key in itertools.islice(keys, self.page_size)]
+                if not page:
+                    break
+                for value in self._read_hashes(page, self._store.mget(page)):
+                    yield self.decode_value(value) if value is not None else default
         else:
-            for key, value in self._items(*args, **kwargs):
-                if value is None:
-                    continue
+            for key, value in self._items(kwargs.get('pattern'), limit=limit):
                 yield self.decode_value(value)
 
-    def items(self, conditions: str = None, limit: int = None, *args, **kwargs):
-        for key, value in self._scan_match(self._items(*args, **kwargs), conditions=conditions, limit=limit):
-            yield key, value
+    def _matched_items(self, conditions: dict, pattern: str = None, limit: int = None):
+        """
+        Yields the items which may match the conditions, as returned from redis.
+        For hashes only the condition fields are fetched and checked, and the full value is fetched for the matches.
+        """
+        fields = list(conditions)
+        encoded = [self.encode_key(field) for field in fields]
+        filters = [self._to_filter(field, condition) for field, condition in conditions.items()]
+        for keys in self._pages(pattern, limit=limit):
+            pipeline = self._store.pipeline(transaction=False)
+            for key in keys:
+                pipeline.hmget(key, encoded)
+            matches = []
+            for key, values in zip(keys, pipeline.execute(raise_on_error=False)):
+                if isinstance(values, Exception):  # not a hash, checked on the full value
+                    matches.append(key)
+                    continue
+                value = {field: self.decode_value(item) for field, item in zip(fields, values) if item is not None}
+                if value and all(validate(value) for validate in filters):
+                    matches.append(key)
+            if matches:
+                values = self._read_hashes(matches, self._store.mget(matches))
+                yield from ((key, value) for key, value in zip(matches, values) if value is not None)
+
+    def items(self, conditions: str = None, limit: int = None, pattern: str = None, *args, **kwargs):
+        if self.hashes and hasattr(conditions, 'items') and conditions and VALUE not in conditions:
+            yield from self._scan_match(self._matched_items(conditions, pattern, limit), conditions=conditions)
+        else:
+            yield from self._scan_match(self._items(pattern, limit=limit), conditions=conditions, limit=limit)
 
     def _flush(self):
         count = len(self)
         self._store.flushdb()
+        if self.cache is not None:
+            self.cache.clear()
         return count
 
     @classmethod
-    def open(cls, url: str, strict: bool = False, **kwargs):
+    def open(cls, url: str, strict: bool = False, page_size: int = REDIS_PAGE_SIZE, batch_window: float = None,
+             batch_size: int = REDIS_BATCH_SIZE, cache_size: int = None, cache_prefixes: typing.Sequence[str] = (),
+             hashes: bool = False, **kwargs):
         kwargs['decode_responses'] = kwargs.get('decode_responses', True)
-        return RedisStore(store=redis.Redis.from_url(url, **kwargs), strict=strict)
+        return RedisStore(store=redis.Redis.from_url(url, **kwargs), strict=strict, page_size=page_size,
+                          batch_window=batch_window, batch_size=batch_size, cache_size=cache_size,
+                          cache_prefixes=cache_prefixes, hashes=hashes)
 
     @classmethod
     def from_connection(cls, host: str = REDIS_DEFAULT_HOST, port: int = REDIS_DEFAULT_PORT,
-                        db: int = None, strict: bool = False, **kwargs):
+                        db: int = None, strict: bool = False, page_size: int = REDIS_PAGE_SIZE,
+                        batch_window: float = None, batch_size: int = REDIS_BATCH_SIZE, cache_size: int = None,
+                        cache_prefixes: typing.Sequence[str] = (), hashes: bool = False, **kwargs):
 
         if db is None:
             store = redis.Redis(host=host, port=port, db=0,
                                 decode_responses=True)
             db = len(RedisStore._databases_names(store))  # TODO test this
         kwargs['decode_responses'] = kwargs.get('decode_responses', True)
-        return RedisStore(store=redis.Redis(host=host, port=port, db=db, **kwargs), strict=strict)
+        return RedisStore(store=redis.Redis(host=host, port=port, db=db, **kwargs), strict=strict,
+                          page_size=page_size, batch_window=batch_window, batch_size=batch_size,
+                          cache_size=cache_size, cache_prefixes=cache_prefixes, hashes=hashes)
 
     @property
     def _backup_path(self):
@@ -181,3 +708,9 @@ class RedisStore(KeyValueStore, Strict):
         if self.strict or isinstance(key, str):
             return key
         return self.encode(key)
+
+    def decode_key(self, key):
+        decoded = super().decode_key(key)
+        if not self.strict and decoded is key and isinstance(key, bytes):  # a str key, from a raw client
+            return key.decode('utf-8')
+        return decoded
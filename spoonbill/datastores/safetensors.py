@@ -181,11 +181,11 @@ class SafetensorsInMemoryStore(InMemoryStore):
 
 
 with contextlib.suppress(ImportError):
-    from spoonbill.datastores.lmdb import LmdbStore
+    from spoonbill.datastores.lmdb import LmdbStore, DEFAULT_MAP_SIZE
 
     class SafetensorsLmdbStore(LmdbStore):
 
-        def __init__(self, path: str, flag: str = "c", mode: int = 0o755, map_size: int = 2 ** 20,
+        def __init__(self, path: str, flag: str = "c", mode: int = 0o755, map_size: int = DEFAULT_MAP_SIZE,
                      autogrow: bool = True,
                      framework='pt', device='cpu'):
             self.store_path = path
@@ -1,38 +1,147 @@
 import contextlib
+import importlib
 import os
+import threading
 
 import shelve
 from spoonbill.datastores.base import ContextStore, Strict
 
+ENGINES = {'gnu': 'dbm.gnu', 'ndbm': 'dbm.ndbm', 'dumb': 'dbm.dumb', 'sqlite3': 'dbm.sqlite3'}
+# the files which the different dbm engines create for a path
+SUFFIXES = ('', '.db', '.dat', '.dir', '.bak', '.pag')
+# open shelves by path as [shelf, users] - stores on the same path share one, so a stale handle never overwrites the
+# files, and it is closed when its last store is closed
+_shelves = {}
+_shelves_lock = threading.Lock()
+
 
 class ShelveStore(ContextStore, Strict):
     """
     A shelve key-value store based on [shelve](https://docs.python.org/3/library/shelve.html).
+
+    The shelf is opened once and kept open until `close`, and shared by the stores on the same path - it is closed
+    when the last of them is closed.
+    `writeback` is off by default, so a value changed in-place is not saved - use `checkout` to track it until `sync`.
+    `engine` selects the dbm backend: gnu, ndbm, dumb or sqlite3 - default is the first available in `dbm`.
     """
     manager = shelve
+    _shelf = None
 
-    def __init__(self, path, strict=True):
+    def __init__(self, path, strict=True, writeback: bool = False, engine: str = None):
         self.store_path = path
         self.strict = strict
-        self.as_string = True
+        self.as_string = False
+        self.writeback = writeback
+        self.engine = engine
+        self._dirty = {}
+
+    def _open(self) -> shelve.Shelf:
+        if self.engine is None:
+            return shelve.open(self.store_path, flag="c", writeback=self.writeback)
+        if self.engine not in ENGINES:
+            raise ValueError(f"Unknown dbm engine {self.engine}, use one of {list(ENGINES)}")
+        dbm = importlib.import_module(ENGINES[self.engine])
+        return shelve.Shelf(dbm.open(self.store_path, "c"), writeback=self.writeback)
+
+    @property
+    def shelf(self) -> shelve.Shelf:
+        if self._shelf is None:
+            with _shelves_lock:
+                entry = _shelves.get(self._key)
+                if entry is None:
+                    entry = _shelves[self._key] = [self._open(), 0]
+                entry[1] += 1
+                self._shelf = entry[0]
+        return self._shelf
+
+    @property
+    def _key(self):
+        return os.path.abspath(self.store_path)
+
+    def _users(self) -> int:
+        with _shelves_lock:
+            entry = _shelves.get(self._key)
+            return entry[1] if entry is not None else 0
 
     @property
     def context(self):
-        return shelve.open(self.store_path, flag="c", writeback=True)
+        return contextlib.nullcontext(self.shelf)
+
+    def checkout(self, key, default=None):
+        """Get a value to change in-place, it is written back on `sync` or `close`"""
+        value = self.get(key, default)
+        self._dirty[key] = value
+        return value
+
+    def sync(self):
+        shelf = self.shelf
+        for key, value in self._dirty.items():
+            shelf[self.encode_key(key)] = self.encode_value(value)
+        self._dirty = {}
+        shelf.sync()
+
+    def close(self):
+        """Writes back the checked out values and releases the shelf"""
+        if self._shelf is None:
+            return
+        self.sync()
+        with _shelves_lock:
+            entry = _shelves[self._key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _shelves[self._key]
+                entry[0].close()
+        self._shelf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     @classmethod
-    def from_db(cls, path, strict: bool = False):
-        return ShelveStore(path=path, strict=strict)
+    def from_db(cls, path, strict: bool = False, writeback: bool = False, engine: str = None):
+        return ShelveStore(path=path, strict=strict, writeback=writeback, engine=engine)
+
+    @staticmethod
+    def _files(path):
+        return [path + suffix for suffix in SUFFIXES if os.path.isfile(path + suffix)]
 
     def _flush(self):
         count = len(self)
-        with contextlib.suppress(FileNotFoundError):
-            os.remove(self.store_path)
+        self._dirty = {}
+        if self._users() > 1:  # other stores use the shelf, so it is emptied instead of removing its files
+            self.shelf.clear()
+            self.shelf.sync()
+            return count
+        self.close()
+        for file in self._files(self.store_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file)
         return count
 
+    def save(self, path):
+        if self._shelf is not None:
+            self.sync()
+        for file in self._files(self.store_path):
+            self._cp(file, path + file[len(self.store_path):])
+        return path
+
+    def load(self, path):
+        self._flush()  # closes the shelf unless other stores use it
+        if self._shelf is not None:  # copied through the shared shelf, its files can't be replaced
+            source = ShelveStore(path, engine=self.engine)
+            self._shelf.update(source.shelf)
+            source.close()
+            self._shelf.sync()
+            return self
+        for file in self._files(path):
+            self._cp(file, self.store_path + file[len(path):])
+        return self
+
     def encode_key(self, key):
         if self.strict:
             return str(key)
-        return self.encode(key)
+        return self.encode(key).decode(self.encoding)  # shelve keys must be strings
 
     open = from_db
@@ -1,6 +1,5 @@
 import contextlib
 import json
-import cloudpickle
 
 from spoonbill.datastores.base import KeyValueStore
 from unqlite import UnQLite
@@ -17,13 +16,13 @@ class UnQLiteStore(KeyValueStore):
     def __init__(self, store: UnQLite = None, strict: bool = True):
         """
         :param store: a dictionary to use as the store
-        :param strict: if False, encode and decode keys and values with cloudpickle
+        :param strict: if False, encode and decode keys and values to bytes
         """
         if store is None:
             store = UnQLite()
         self._store = store
         self.strict = strict
-        self.as_string = not strict
+        self.as_string = False
 
     @classmethod
     def from_dict(cls, d: dict, strict=True):
@@ -76,21 +75,9 @@ class UnQLiteStore(KeyValueStore):
     def load(cls, path, **kwargs):
         return cls.open(path=path, **kwargs)
 
-    def encode(self, value):
-        """Encode a value to a string.
-        Note were using the str instead of encoding to bytes because it works best with
-        numbers too without creating issues with different encodings.
-        """
-        encoded = cloudpickle.dumps(value)
-        return str(encoded)
-
-    def decode(self, value):
-        if value is not None:
-            if self._is_encoded(value):
-                value = eval(value)
-                value = cloudpickle.loads(value)
-                return value
-            return value
-
-    def _is_encoded(self, value):
-        return str(value)[:3] in ('b"\\', "b'\\", 'b"b', "b'b", 'b"b', "b'b")
+    def decode_key(self, key):
+        if self.strict:
+            return key
+        if isinstance(key, str):  # unqlite returns keys which are valid utf-8 as strings
+            key = key.encode('utf-8')
+        return self.decode(key)
@@ -1,6 +1,11 @@
 import re
+import hashlib
+import json
 import pathlib
-from typing import Any
+from typing import Any, Optional
+
+# the file at the root of a fanned-out store which records its layout
+LAYOUT_FILE = '.layout'
 
 
 def is_cloud_url(path: str) -> bool:
@@ -12,3 +17,23 @@ def get_pathlib(path: str) -> Any:
         import cloudpathlib
         return cloudpathlib.CloudPath(path)
     return pathlib.Path(path)
+
+
+def fanout_prefix(key: str, levels: int) -> str:
+    """The directories of a key in a fanned-out layout - 'ab/cd' for 2 levels, from a hash of the key"""
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return '/'.join(digest[2 * i:2 * i + 2] for i in range(levels))
+
+
+def resolve_fanout(layout: Optional[bytes], fanout: Optional[int]) -> int:
+    """The number of fan-out levels from the layout file's content, which must agree with `fanout` if both are given"""
+    stored = json.loads(layout)['fanout'] if layout else None
+    if stored is not None and fanout is not None and stored != fanout:
+        raise ValueError(f"The store has a fanout of {stored}, not {fanout}")
+    if stored is not None:
+        return stored
+    return fanout or 0
+
+
+def layout_content(fanout: int) -> bytes:
+    return json.dumps({'fanout': fanout}).encode()
@@ -1,15 +1,137 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from fsspec import AbstractFileSystem, get_filesystem_class
 from fsspec.implementations.cached import SimpleCacheFileSystem
+from fsspec.implementations.local import LocalFileSystem
+import datetime
+import hashlib
+import os
+import shutil
+import threading
 import typing
 import fsspec
+import fsspec.asyn
+
+DEFAULT_CONCURRENCY = 32
+COPY_CHUNK_SIZE = 2 ** 23
+
+
+class ReadCache:
+    """
+    A size-bounded on-disk cache for reads of remote files.
+    Before an entry is served, it is validated against the file's ETag, or its modification time and size - a single
+    metadata request instead of a download. The least recently used entries are evicted above `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 2 ** 30):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # name -> size, least recently used first
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and not entry.name.endswith('.tmp')]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            self._entries[entry.name] = entry.stat().st_size
+        self.size = sum(self._entries.values())
+
+    @staticmethod
+    def _version(info: dict) -> bytes:
+        for name in ('ETag', 'etag', 'md5Hash', 'mtime', 'LastModified', 'last_modified', 'updated', 'created'):
+            if info.get(name) is not None:
+                return f"{name}={info[name]}:{info.get('size')}".replace('\n', ' ').encode()
+        return f"size={info.get('size')}".encode()
+
+    @staticmethod
+    def _name(fs: AbstractFileSystem, path: str) -> str:
+        protocol = fs.protocol if isinstance(fs.protocol, str) else fs.protocol[0]
+        return hashlib.sha256(f"{protocol}://{fs._strip_protocol(path)}".encode()).hexdigest()
+
+    def read(self, fs: AbstractFileSystem, path: str) -> bytes:
+        version = self._version(fs.info(path))
+        name = self._name(fs, path)
+        file = os.path.join(self.cache_dir, name)
+        if name in self._entries:
+            try:
+                with open(file, 'rb') as f:  # the first line is the version of the cached content
+                    if f.readline() == version + b'\n':
+                        data = f.read()
+                        with self._lock:
+                            self.hits += 1
+                            if name in self._entries:
+                                self._entries.move_to_end(name)
+                        os.utime(file)
+                        return data
+            except FileNotFoundError:  # evicted meanwhile
+                pass
+        with self._lock:
+            self.misses += 1
+        data = fs.cat_file(path)
+        self._add(name, version + b'\n' + data)
+        return data
+
+    def _add(self, name: str, content: bytes):
+        if len(content) > self.max_bytes:
+            return
+        file = os.path.join(self.cache_dir, name)
+        temp_file = f"{file}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(content)
+        os.replace(temp_file, file)
+        with self._lock:
+            self.size += len(content) - self._entries.pop(name, 0)
+            self._entries[name] = len(content)
+            while self.size > self.max_bytes and self._entries:
+                evicted, size = self._entries.popitem(last=False)
+                try:
+                    os.remove(os.path.join(self.cache_dir, evicted))
+                except FileNotFoundError:
+                    pass
+                self.size -= size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'entries': len(self._entries), 'size': self.size, 'max_bytes': self.max_bytes}
+
+    def clear(self):
+        with self._lock:
+            for name in self._entries:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+            self._entries.clear()
+            self.size = 0
+
+
+_default_cache: typing.Optional[ReadCache] = None
+
+
+def set_default_cache(cache: typing.Optional[ReadCache]) -> typing.Optional[ReadCache]:
+    """Set a ReadCache used by every FileSystem which isn't given one - the stores and all save/load calls"""
+    global _default_cache
+    _default_cache = cache
+    return cache
+
+
+def get_default_cache() -> typing.Optional[ReadCache]:
+    return _default_cache
 
 
 class FileSystem:
 
-    def __init__(self, path, **kwargs):
+    def __init__(self, path, cache: ReadCache = None, **kwargs):
         self.path = path
         self.fs = self.get_filesystem_from_path(path, **kwargs)
         self.kwargs = kwargs
+        self.cache = cache if cache is not None else _default_cache
+        if self.get_protocol_from_path(path) == "file":
+            self.cache = None  # local files are not cached
 
     @classmethod
     def get_filesystem(cls, protocol: str, **kwargs) -> AbstractFileSystem:
@@ -31,21 +153,140 @@ class FileSystem:
 
         # If a cache location is set and the protocol is not a local file, use as a simple disk-based cache
         if protocol != "file" and cache_location is not None:
-            fs = SimpleCacheFileSystem(fs=fs, cache_storage=str(cache_location / "simple-cache-file-system"))
+            fs = SimpleCacheFileSystem(fs=fs, cache_storage=os.path.join(str(cache_location), "simple-cache-file-system"))
         return fs
 
+    def get_many(self, paths: typing.List[str], concurrency: int = DEFAULT_CONCURRENCY) -> typing.Dict[str, bytes]:
+        """
+        Read many files at once, returns {path: bytes} without the missing ones.
+        Async filesystems (s3, gs, az, http) run `concurrency` requests at a time, others use as many threads.
+        """
+        paths = list(paths)
+        if self.cache is None and getattr(self.fs, 'async_impl', False):
+            # _cat_file per path - cat() would expand keys with glob characters (*?[) into other files
+            results = fsspec.asyn.sync(self.fs.loop, fsspec.asyn._run_coros_in_chunks,
+                                       [self.fs._cat_file(path) for path in paths],
+                                       batch_size=concurrency, return_exceptions=True)
+            found = {}
+            for path, data in zip(paths, results):
+                if isinstance(data, (FileNotFoundError, IsADirectoryError)):
+                    continue
+                if isinstance(data, Exception):
+                    raise data
+                found[path] = data
+            return found
+
+        def read(path):
+            try:
+                return path, self.read_file(path)
+            except (FileNotFoundError, IsADirectoryError):
+                return path, None
+
+        with ThreadPoolExecutor(max(1, min(concurrency, len(paths)))) as pool:
+            return {path: data for path, data in pool.map(read, paths) if data is not None}
+
+    def set_many(self, data: typing.Dict[str, bytes], concurrency: int = DEFAULT_CONCURRENCY):
+        """Write many files at once, `concurrency` requests or threads at a time"""
+        if getattr(self.fs, 'async_impl', False):
+            self.fs.pipe(data, batch_size=concurrency)
+            return
+        for parent in {self.fs._parent(path) for path in data}:
+            self.fs.makedirs(parent, exist_ok=True)
+        with ThreadPoolExecutor(max(1, min(concurrency, len(data)))) as pool:
+            list(pool.map(lambda item: self.fs.pipe_file(*item), data.items()))
+
     def write_bytes(self, data: typing.Union[bytes, str]):
         self.fs.write_bytes(self.path, data)
 
+    def read_file(self, path: str) -> bytes:
+        """Read a file through the read cache, if there is one"""
+        if self.cache is not None:
+            return self.cache.read(self.fs, path)
+        return self.fs.cat_file(path)
+
     def read_bytes(self) -> bytes:
-        return self.fs.read_bytes(self.path)
+        return self.read_file(self.path)
 
     @staticmethod
-    def copy_dir(source: str, target: str, **kwargs):
-        source_path = fsspec.get_mapper(source, **kwargs)
-        target_path = fsspec.get_mapper(target, **kwargs)
-        for key, value in source_path.items():
-            target_path[key] = value
+    def _modified(info: dict) -> typing.Optional[float]:
+        """The modification time of a file from fsspec's info of any filesystem, as a timestamp"""
+        for name in ('mtime', 'LastModified', 'last_modified', 'updated', 'created'):
+            value = info.get(name)
+            if isinstance(value, datetime.datetime):
+                return value.timestamp()
+            if isinstance(value, (int, float)):
+                return float(value)
+            if isinstance(value, str):
+                try:
+                    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+                except ValueError:
+                    continue
+        return None
+
+    @staticmethod
+    def _md5(fs: AbstractFileSystem, path: str) -> str:
+        digest = hashlib.md5()
+        with fs.open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def _changed(cls, source_fs, source_info: dict, target_fs, target_info: dict, checksum: bool) -> bool:
+        if target_info is None or source_info.get('size') != target_info.get('size'):
+            return True
+        if checksum:
+            return cls._md5(source_fs, source_info['name']) != cls._md5(target_fs, target_info['name'])
+        source_modified, target_modified = cls._modified(source_info), cls._modified(target_info)
+        if source_modified is None or target_modified is None:
+            return True
+        if isinstance(target_fs, LocalFileSystem):  # copies keep the source's mtime, like rsync
+            return abs(source_modified - target_modified) > 1e-3
+        return source_modified > target_modified  # the target was written after the source was last changed
+
+    @classmethod
+    def copy_dir(cls, source: str, target: str, concurrency: int = DEFAULT_CONCURRENCY, checksum: bool = False,
+                 delete: bool = False, **kwargs):
+        """
+        Sync target with source - only the files which are missing, have a different size, or a different mtime
+        (on a remote target, changed after they were copied), or a different md5 with `checksum`, are copied.
+        Files are streamed in chunks by `concurrency` threads, and copied server-side within the same filesystem.
+        With `delete`, files in the target which are not in the source are removed.
+        """
+        source_fs, source_root = fsspec.core.url_to_fs(source, **kwargs)
+        target_fs, target_root = fsspec.core.url_to_fs(target, **kwargs)
+        source_root, target_root = source_root.rstrip('/'), target_root.rstrip('/')
+        source_files = {name[len(source_root) + 1:]: info
+                        for name, info in source_fs.find(source_root, detail=True).items() if info['type'] == 'file'}
+        target_files = {}
+        if target_fs.exists(target_root):
+            target_files = {name[len(target_root) + 1:]: info
+                            for name, info in target_fs.find(target_root, detail=True).items()
+                            if info['type'] == 'file'}
+        changed = [name for name, info in source_files.items()
+                   if cls._changed(source_fs, info, target_fs, target_files.get(name), checksum)]
+        same_filesystem = source_fs is target_fs
+
+        def copy(name):
+            source_path, target_path = f"{source_root}/{name}", f"{target_root}/{name}"
+            target_fs.makedirs(target_fs._parent(target_path), exist_ok=True)
+            if same_filesystem:
+                source_fs.copy(source_path, target_path)
+            else:
+                with source_fs.open(source_path, 'rb') as source_file, \
+                        target_fs.open(target_path, 'wb') as target_file:
+                    shutil.copyfileobj(source_file, target_file, COPY_CHUNK_SIZE)
+            modified = cls._modified(source_files[name])
+            if isinstance(target_fs, LocalFileSystem) and modified is not None:
+                os.utime(target_path, (modified, modified))
+
+        if changed:
+            with ThreadPoolExecutor(max(1, min(concurrency, len(changed)))) as pool:
+                list(pool.map(copy, changed))
+        if delete:
+            removed = [f"{target_root}/{name}" for name in target_files if name not in source_files]
+            if removed:
+                target_fs.rm(removed)
         return True
 
     def get_mapper(self):
@@ -1,6 +1,8 @@
+import os
 from tempfile import TemporaryDirectory
 from spoonbill.datastores.inmemory import InMemoryStore
 from spoonbill.datastores.filesystem import FilesystemStore
+from spoonbill.datastores.buckets import BucketStore, PackedBucketStore
 import pytest
 
 
@@ -38,6 +40,98 @@ def test_filesystem_dict():
     assert len([1 for _ in store]) == N  # test iterator
 
 
+def test_bucketstore():
+    tmpdir = TemporaryDirectory()
+    store = BucketStore.open(tmpdir.name + '/bucket')
+    store['test'] = 'test'
+    store['test'] = 'again'  # no double counting
+    store.update({'another': {'a': 1}, 'third': 3})
+    assert len(store) == 3
+    assert store['test'] == 'again' and store.get('nope', 'nope') == 'nope' and 'third' in store
+    assert set(store.keys()) == {'test', 'another', 'third'}
+    assert list(store.keys(pattern='th*')) == ['third']
+    assert store.pop('third') == 3 and store.pop('third') is None
+    del store['another']
+    assert len(store) == 1
+    with pytest.raises(KeyError):
+        del store['another']
+
+    other = BucketStore.open(tmpdir.name + '/bucket')  # another writer
+    other['new'] = 'new'
+    assert len(store) == 2
+
+
+@pytest.mark.parametrize('klass', [FilesystemStore, BucketStore])
+def test_fanout(klass):
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/store'
+    store = klass.open(path, fanout=2)
+    store.update({str(i): i for i in range(20)})
+    store['test'] = {'a': 'x'}
+    assert len(store) == 21 and store['7'] == 7 and store.get('test') == {'a': 'x'}
+    assert set(store.keys()) == {str(i) for i in range(20)} | {'test'}
+    assert list(store.items(conditions={'a': 'x'})) == [('test', {'a': 'x'})]
+    assert store.pop('7') == 7 and len(store) == 20
+    assert sorted(os.listdir(path)) != sorted(store.keys())  # nested directories
+    assert all(len(name) == 2 for name in os.listdir(path) if name != '.layout')
+
+    store = klass.open(path)  # the layout is read from the marker
+    assert store.fanout == 2 and store['8'] == 8
+    with pytest.raises(ValueError):
+        klass.open(path, fanout=1)
+    assert store._flush() == 20
+    assert len(store) == 0 and klass.open(path).fanout == 2
+
+    flat = klass.open(tmpdir.name + '/flat')
+    flat['test'] = 'test'
+    with pytest.raises(ValueError):
+        klass.open(tmpdir.name + '/flat', fanout=2)
+
+
+@pytest.mark.parametrize('fanout', [None, 2])
+def test_filesystem_many(fanout):
+    tmpdir = TemporaryDirectory()
+    for path in [tmpdir.name + '/store', f'memory://store-{fanout}']:
+        store = FilesystemStore.open(path, fanout=fanout, concurrency=4)
+        store.set_many({str(i): i for i in range(100)})
+        store.update({'test': {'a': 1}})
+        assert len(store) == 101
+        assert store.get_many(['1', '2', 'nope']) == {'1': 1, '2': 2}
+        assert list(store.values(['3', 'nope', 'test'], default='default')) == [3, 'default', {'a': 1}]
+        assert sorted(value for value in store.values() if isinstance(value, int)) == list(range(100))
+        store._flush()
+
+
+def test_packed_bucketstore():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/packed'
+    store = PackedBucketStore.open(path, segment_size=100)
+    store.update({str(i): i for i in range(50)})
+    store['test'] = {'a': 'x'}
+    assert len(store) == 51 and store['7'] == 7 and store.get('nope', 'nope') == 'nope'
+    del store['7']
+    assert '7' not in store and store.pop('8') == 8 and store.pop('8') is None
+    store.close()
+    segments = [name for name in os.listdir(path) if name.endswith('.seg')]
+    assert 1 < len(segments) < 50
+
+    other = PackedBucketStore.open(path)  # another writer
+    assert len(other) == 49 and '7' not in other and other['test'] == {'a': 'x'}
+    other['new'] = 'new'
+    other.flush()
+    assert 'new' not in store and 'new' in store.refresh()
+    assert list(store.items(conditions={'a': 'x'})) == [('test', {'a': 'x'})]
+    assert len(list(store.values())) == 50 and list(store.values(['9'])) == [9]
+
+    store.segment_size = 2 ** 20
+    assert store.compact() == len(segments) + 1
+    assert len(os.listdir(path)) == 2  # a single segment and its index
+    assert PackedBucketStore.open(path) == {**{str(i): i for i in range(50) if i not in (7, 8)},
+                                            'test': {'a': 'x'}, 'new': 'new'}
+    assert store._flush() == 50
+    assert len(PackedBucketStore.open(path)) == 0
+
+
 @pytest.mark.skip("Run manually")
 def test_buclketdict_s3():
     path = 's3://xdss-tmp/tmp.db/'
@@ -0,0 +1,70 @@
+import cloudpickle
+import pytest
+
+from spoonbill.datastores.codecs import CODECS, to_tagged, from_tagged, get_codec
+from spoonbill.datastores.inmemory import InMemoryStore
+
+
+def test_codecs_round_trip():
+    values = [b'bytes', 'string', 1, 2 ** 70, 1.5, None, True, (1, 2), [1, (2, 3)], {1: 'a', 'b': [1.0]},
+              {'a', 'b'}, lambda x: x + 1]
+    for value in values:
+        decoded = from_tagged(to_tagged(value))
+        if callable(value):
+            assert decoded(1) == 2
+        else:
+            assert decoded == value and type(decoded) is type(value)
+
+    assert get_codec(to_tagged(b'bytes')).name == 'raw'
+    assert get_codec(to_tagged({'a': 1})).name == 'pickle'
+    assert get_codec(to_tagged(lambda x: x)).name == 'cloudpickle'
+
+
+@pytest.mark.parametrize('name', ['msgpack', 'orjson'])
+def test_codecs_optional(name):
+    if name not in CODECS:
+        pytest.skip(f"{name} is not installed")
+    codecs = (name, 'pickle', 'cloudpickle')
+    for value in [{'a': [1, 2.5, None, True]}, 'string', (1, 2), {1: 'a'}, float('nan')]:
+        encoded = to_tagged(value, codecs)
+        decoded = from_tagged(encoded)
+        assert type(decoded) is type(value)
+        if value == value:
+            assert decoded == value
+    assert get_codec(to_tagged({'a': [1, 2]}, codecs)).name == name
+    assert get_codec(to_tagged((1, 2), codecs)).name == 'pickle'
+
+
+def test_strict_encoding():
+    store = InMemoryStore(strict=False, as_string=True)
+    store.update({1: 1, 'test': {'a': 1}, b'raw': b'raw'})
+    assert all(isinstance(key, str) for key in store._store)
+    assert store[1] == 1 and store['test'] == {'a': 1} and store[b'raw'] == b'raw'
+
+    store = InMemoryStore(strict=False, as_string=False)
+    store[b'raw'] = b'raw'
+    assert store._store[b'\x01raw'] == b'\x01raw'
+
+    # values from older versions
+    assert store.decode(cloudpickle.dumps({'a': 1})) == {'a': 1}
+    assert store.decode(str(cloudpickle.dumps({'a': 1}))) == {'a': 1}
+    assert store.decode('plain') == 'plain'
+
+
+def test_strict_encoding_utf8_transport():
+    store = InMemoryStore(strict=False, as_string=True)
+    for value in ['a', 1, {'a': 1}, b'\xff\x00', 'caf\xe9 \u2603']:
+        assert store.decode(store.encode(value).encode('utf-8')) == value  # a backend returning utf-8 bytes
+        assert store.decode(store.encode(value)) == value
+    assert store.decode(cloudpickle.dumps({'a': 1})) == {'a': 1}
+
+
+def test_codecs_numpy():
+    np = pytest.importorskip('numpy')
+    codecs = ('raw', 'numpy', 'pickle', 'cloudpickle')
+    for value in [np.arange(6, dtype=np.int16).reshape(2, 3), np.array(1.5), np.arange(10)[::3]]:
+        encoded = to_tagged(value, codecs)
+        assert get_codec(encoded).name == 'numpy'
+        decoded = from_tagged(encoded)
+        assert np.array_equal(decoded, value) and decoded.dtype == value.dtype
+    assert get_codec(to_tagged(np.array([{}, 1]), codecs)).name == 'pickle'  # object arrays
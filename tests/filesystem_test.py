@@ -0,0 +1,98 @@
+from tempfile import TemporaryDirectory
+
+import fsspec
+
+from spoonbill.datastores.buckets import PackedBucketStore
+from spoonbill.datastores.filesystem import FilesystemStore
+from spoonbill.datastores.inmemory import InMemoryStore
+from spoonbill.filesystem import FileSystem, ReadCache, set_default_cache
+
+
+def test_read_cache():
+    tmpdir = TemporaryDirectory()
+    cache = ReadCache(tmpdir.name + '/cache', max_bytes=1000)
+    path = 'memory://cache-test/file'
+    FileSystem(path).write_bytes(b'first')
+    assert FileSystem(path, cache=cache).read_bytes() == b'first'
+    assert FileSystem(path, cache=cache).read_bytes() == b'first'
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    FileSystem(path).write_bytes(b'second')  # a new version is not served from the cache
+    assert FileSystem(path, cache=cache).read_bytes() == b'second'
+    assert cache.stats()['misses'] == 2 and cache.stats()['entries'] == 1
+
+    for i in range(5):
+        FileSystem(f'memory://cache-test/big{i}').write_bytes(b'x' * 300)
+        FileSystem(f'memory://cache-test/big{i}', cache=cache).read_bytes()
+    stats = cache.stats()
+    assert stats['size'] <= 1000 and stats['evictions'] >= 3
+
+    cache = ReadCache(tmpdir.name + '/cache', max_bytes=1000)  # the entries on disk are reused
+    assert cache.stats()['entries'] == stats['entries']
+    assert FileSystem('memory://cache-test/big4', cache=cache).read_bytes() == b'x' * 300
+    assert cache.stats()['hits'] == 1
+
+    fs = FileSystem.get_filesystem_from_path('memory://cache-test/file', cache_location=tmpdir.name)
+    assert fs.cat_file('memory://cache-test/file') == b'second'
+
+
+def test_read_cache_stores():
+    tmpdir = TemporaryDirectory()
+    cache = ReadCache(tmpdir.name + '/cache')
+    store = FilesystemStore.open('memory://cache-store', cache=cache)
+    store.update({str(i): i for i in range(10)})
+    assert store['1'] == store['1'] == 1 and store.get('nope') is None
+    assert list(store.values(['2', '3'])) == [2, 3]
+    assert cache.stats()['hits'] == 1
+
+    packed = PackedBucketStore.open('memory://cache-packed', cache=cache)
+    packed.update({str(i): i for i in range(10)})
+    packed.flush()
+    assert packed['1'] == 1 and packed['2'] == 2  # one segment, cached once
+    assert cache.stats()['hits'] == 2
+
+    set_default_cache(cache)
+    try:
+        InMemoryStore(strict=False).update({'a': 1}).save('memory://cache-save/store')
+        assert InMemoryStore.load('memory://cache-save/store')['a'] == 1
+        assert InMemoryStore.load('memory://cache-save/store')['a'] == 1
+        assert cache.stats()['hits'] == 3
+    finally:
+        set_default_cache(None)
+
+
+def test_copy_dir():
+    tmpdir = TemporaryDirectory()
+    source, target = tmpdir.name + '/source', 'memory://copy-target'
+    fs = fsspec.filesystem('file')
+    for i in range(20):
+        fs.makedirs(f"{source}/{i % 3}", exist_ok=True)
+        fs.pipe_file(f"{source}/{i % 3}/{i}", str(i).encode() * 10)
+    assert FileSystem.copy_dir(source, target, concurrency=4)
+    target_fs = fsspec.filesystem('memory')
+    assert target_fs.cat_file('/copy-target/2/5') == b'5' * 10
+    created = {name: info['created'] for name, info in target_fs.find('/copy-target', detail=True).items()}
+
+    fs.pipe_file(f"{source}/1/1", b'changed')
+    fs.pipe_file(f"{source}/new", b'new')
+    FileSystem.copy_dir(source, target)
+    after = {name: info['created'] for name, info in target_fs.find('/copy-target', detail=True).items()}
+    assert target_fs.cat_file('/copy-target/1/1') == b'changed' and target_fs.cat_file('/copy-target/new') == b'new'
+    assert [name for name in created if after[name] != created[name]] == ['/copy-target/1/1']  # only the changed file
+
+    fs.rm(f"{source}/new")
+    FileSystem.copy_dir(source, target, checksum=True, delete=True)
+    assert not target_fs.exists('/copy-target/new')
+    local_target = tmpdir.name + '/target'
+    FileSystem.copy_dir(source, local_target)
+    assert fs.cat_file(f"{local_target}/0/3") == b'3' * 10
+
+
+def test_get_many_async():
+    from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
+
+    filesystem = FileSystem('memory://get-many/')
+    filesystem.fs = AsyncFileSystemWrapper(fsspec.filesystem('memory'))
+    filesystem.set_many({'/get-many/a*': b'star', '/get-many/a1': b'one', '/get-many/b[1]': b'bracket'})
+    paths = ['/get-many/a*', '/get-many/b[1]', '/get-many/missing?']
+    assert filesystem.get_many(paths, concurrency=2) == {'/get-many/a*': b'star', '/get-many/b[1]': b'bracket'}
@@ -1,3 +1,5 @@
+import json
+import os
 from tempfile import TemporaryDirectory
 from spoonbill.datastores.jsonstore import JsonStore
 import pytest
@@ -52,3 +54,106 @@ def test_jsondicks3():
     assert store['test'] == store.get('test') == 'test'
     store.set('another', 'another')
     assert 'test' in store  # test contains
+
+
+def test_jsonlog():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.jsonl'
+    store = JsonStore.open(path, strict=True, log=True)
+    store.update({'a': 1, 'b': {'c': [1, 2]}, 3: 'three'})
+    store['a'] = 2
+    assert store.pop('b') == {'c': [1, 2]}
+    assert len(store) == 2 and store['a'] == 2 and store[3] == 'three' and 'b' not in store
+    assert set(store.items()) == {('a', 2), (3, 'three')}
+
+    other = JsonStore.open(path, strict=True, log=True)  # index rebuilt from the log
+    assert other == {'a': 2, 3: 'three'}
+    other['d'] = 4
+    assert store['d'] == 4  # appended by another handle
+
+    assert store.compact() > 0
+    assert len(open(path).readlines()) == 3
+    assert other['a'] == 2 and len(other) == 3  # replaced by another handle
+
+    with open(path, 'a') as file:
+        file.write('["e", ')  # a partial write
+    store = JsonStore.open(path, strict=True, log=True)
+    assert store == {'a': 2, 3: 'three', 'd': 4}
+    store['e'] = 5
+    assert JsonStore.open(path, strict=True, log=True) == {'a': 2, 3: 'three', 'd': 4, 'e': 5}
+
+    store = JsonStore.open(path, strict=False, log=True)
+    assert store._flush() == 4
+    store.update({(1, 2): lambda x: x + 1, 'b': [1]})
+    assert store[(1, 2)](1) == 2 and store['b'] == [1]
+
+
+def test_jsonlog_auto_compact(monkeypatch):
+    from spoonbill.datastores import jsonstore
+    monkeypatch.setattr(jsonstore, 'MIN_COMPACT_SIZE', 0)
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.jsonl'
+    store = JsonStore.open(path, strict=True, log=True, compact_ratio=0.5)
+    for i in range(100):
+        store['key'] = i
+    assert store['key'] == 99
+    assert len(open(path).readlines()) <= 2
+
+
+@pytest.mark.parametrize('use_orjson', [False, True])
+def test_json_cache(use_orjson):
+    if use_orjson:
+        pytest.importorskip('orjson')
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.json'
+    store = JsonStore.open(path, strict=True, use_orjson=use_orjson, indent=None, cache=True)
+    store.update({'a': 1, 'b': [1, 2]})
+    text = open(path).read()
+    assert '\n' not in text
+    stamp = os.stat(path).st_mtime_ns
+    assert store['a'] == 1 and 'b' in store and len(store) == 2
+    assert os.stat(path).st_mtime_ns == stamp  # reads don't write
+    assert store.context.data is not None
+
+    other = JsonStore.open(path, strict=True)
+    other['c'] = 3
+    assert store['c'] == 3  # the cache is revalidated
+    assert json.loads(open(path).read()) == {'a': 1, 'b': [1, 2], 'c': 3}
+    assert not [name for name in os.listdir(tmpdir.name) if name.endswith('.tmp')]
+
+    store = JsonStore.open(path, strict=True)  # without the cache, returned values are not shared
+    store['d'] = {'x': 1}
+    store['d']['x'] = 999
+    store['e'] = 2
+    assert store['d'] == {'x': 1}
+
+
+def test_json_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    tmpdir = TemporaryDirectory()
+    store = JsonStore.open(tmpdir.name + '/tmp.json', strict=True, lockfile_path=tmpdir.name + '/tmp.lock')
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: store.set(str(i), i), range(200)))
+    assert len(store) == 200
+
+
+def test_json_shards():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/shards'
+    store = JsonStore.open(path, strict=True, shards=4, lockfile_path=tmpdir.name + '/tmp.lock')
+    store.update({str(i): i for i in range(100)})
+    assert len(os.listdir(path)) == 4
+    assert len(store) == 100 and store['42'] == 42 and '42' in store
+    assert store.pop('42') == 42 and store.pop('42', 'nope') == 'nope'
+    store['new'] = [1, 2]
+    assert set(store.keys()) == {str(i) for i in range(100) if i != 42} | {'new'}
+    assert dict(store.items(conditions={'VALUE__': 7})) == {'7': 7}
+
+    stamps = {name: os.stat(os.path.join(path, name)).st_mtime_ns for name in os.listdir(path)}
+    store['new'] = 1
+    changed = [name for name in os.listdir(path) if os.stat(os.path.join(path, name)).st_mtime_ns != stamps[name]]
+    assert len(changed) == 1  # only the key's shard is written
+
+    assert JsonStore.open(path, strict=True, shards=4) == store
+    assert store._flush() == 100
+    assert len(store) == 0
@@ -1,3 +1,7 @@
+import sys
+
+import lmdb
+import pytest
 from spoonbill.datastores.lmdb import LmdbStore
 from tempfile import TemporaryDirectory
 
@@ -70,3 +74,161 @@ def test_lmdb_search():
     assert list(store.keys(pattern=1)) == [1]
     assert list(store.values(keys=['10', '13'])) == [
         {'a': 10, 'b': '10'}, {'a': 13, 'b': '13'}]
+
+
+def test_lmdb_persistent_environment():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    with LmdbStore.open(path) as store:
+        env = store.db.env
+        store['test'] = 'test'
+        assert store.get('test') == 'test'
+        assert store.get('nope') is None
+        assert 'test' in store and len(store) == 1
+        assert store.db.env is env  # the same environment is used for every operation
+    assert store._db is None
+
+    store = LmdbStore.open(path)  # reopens after close
+    assert store['test'] == 'test'
+    store.close()
+
+
+def test_lmdb_shared_environment():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    store, other = LmdbStore.open(path), LmdbStore.open(path)
+    store.update({i: i for i in range(10)})
+    other._flush()  # emptied in a transaction, the files are still used by store
+    assert len(store) == len(other) == 0
+    other[1] = 'x'
+    other.save(tmpdir.name + '/saved.db')
+    other[2] = 'y'
+    store.load(tmpdir.name + '/saved.db')  # replaced in a transaction, other sees it
+    assert dict(other.items()) == {1: 'x'}
+    with pytest.raises(ValueError):
+        LmdbStore.open(path, flag='r', lock=False).get(1)  # open for writing, with locks
+    other.close()
+    assert dict(LmdbStore.open(path).items()) == {1: 'x'}
+
+    tmpdir = TemporaryDirectory()
+    store = LmdbStore.open(tmpdir.name + '/strict.db', raw=True)
+    store.update({'b': b'2', b'a': '1'})
+    assert list(store.keys()) == [b'a', b'b']  # native ordering
+    assert store['a'] == b'1' and store.get(b'b') == b'2'
+
+    store = LmdbStore.open(tmpdir.name + '/tmp.db', strict=False, raw=True)
+    store.update({'b': {'b': 2}, 'a': 1, 1: [1], b'c': b'c'})
+    assert store.db.env.begin().get(b'a') == store.encode_value(1)  # encoded once
+    assert list(store.keys())[-2:] == ['a', 'b']
+    assert store['a'] == 1 and store[1] == [1] and store[b'c'] == b'c'
+    assert dict(store.items()) == {'b': {'b': 2}, 'a': 1, 1: [1], b'c': b'c'}
+
+
+def test_lmdb_reader():
+    np = pytest.importorskip('numpy')
+    tmpdir = TemporaryDirectory()
+    store = LmdbStore.open(tmpdir.name + '/strict.db', raw=True)
+    store.update({'a': b'1', 'b': b'2'})
+    with store.reader() as reader:
+        value = reader['a']
+        assert isinstance(value, memoryview) and bytes(value) == b'1'
+        assert list(map(bytes, reader.values(keys=['b', 'a']))) == [b'2', b'1']
+        assert reader.get('c') is None and 'b' in reader
+
+    store = LmdbStore.open(tmpdir.name + '/tmp.db', strict=False, raw=True,
+                           codecs=('raw', 'numpy', 'pickle', 'cloudpickle'))
+    vectors = {str(i): np.arange(i, i + 4, dtype=np.float32).reshape(2, 2) for i in range(10)}
+    store.update(vectors)
+    assert np.array_equal(store['3'], vectors['3'])
+    with store.reader() as reader:
+        for key, value in zip(['1', '5'], reader.values(keys=['1', '5'])):
+            assert not value.flags.writeable and np.array_equal(value, vectors[key])
+    assert [value.shape for value in store.values(keys=['1', '2'])] == [(2, 2), (2, 2)]
+
+
+def test_lmdb_bulk_load():
+    tmpdir = TemporaryDirectory()
+    store = LmdbStore.open(tmpdir.name + '/tmp.db', strict=False, raw=True)
+    store['0'] = 'existing'
+    data = [(str(i), {'value': i}) for i in reversed(range(1, 1000))] + [('5', 'last')]
+    assert store.bulk_load(data, batch_size=100, run_size=300) == 999
+    assert len(store) == 1000
+    assert store['0'] == 'existing' and store['5'] == 'last' and store['999'] == {'value': 999}
+    assert list(store.keys())[:3] == ['0', '1', '10']
+
+    store = LmdbStore.open(tmpdir.name + '/sorted.db', raw=True)
+    assert store.bulk_load(((b'%05d' % i, b'x' * 100) for i in range(5000)), presorted=True, batch_size=1000) == 5000
+    assert len(store) == 5000 and store[b'04999'] == b'x' * 100
+    with pytest.raises(ValueError):
+        store.bulk_load([(b'2', b''), (b'1', b'')], presorted=True)
+
+
+def test_lmdb_map_growth():
+    tmpdir = TemporaryDirectory()
+    store = LmdbStore.open(tmpdir.name + '/tmp.db', raw=True, map_size=2 ** 16, growth_factor=1.5)
+    usage = store.usage()
+    assert usage['map_size'] == 2 ** 16 and usage['entries'] == 0
+    store['one'] = b'x' * 2 ** 17  # bigger than the map
+    assert store.usage()['map_size'] >= 2 ** 17
+    store.update({str(i): b'x' * 1000 for i in range(1000)})  # reserved ahead from the batch size
+    usage = store.usage()
+    assert usage['entries'] == 1001 and usage['used'] <= usage['map_size']
+
+    store = LmdbStore.open(tmpdir.name + '/fixed.db', raw=True, map_size=2 ** 16, autogrow=False)
+    with pytest.raises(lmdb.MapFullError):
+        store['one'] = b'x' * 2 ** 17
+
+
+def test_lmdb_named_databases():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    users = LmdbStore.open(path, name='users', strict=False, raw=True)
+    orders = LmdbStore.open(path, name='orders', strict=False, raw=True)
+    assert users.db.environment is orders.db.environment  # one environment
+    users['a'] = {'orders': 0}
+    assert len(users) == 1 and len(orders) == 0 and 'a' not in orders
+
+    with users.transaction(orders) as (users_txn, orders_txn):
+        users_txn['a'] = {'orders': 1}
+        orders_txn['1'] = {'user': 'a'}
+    assert users['a'] == {'orders': 1} and orders['1'] == {'user': 'a'}
+
+    with pytest.raises(RuntimeError):
+        with users.transaction(orders) as (users_txn, orders_txn):
+            users_txn['b'] = {'orders': 1}
+            orders_txn['2'] = {'user': 'b'}
+            raise RuntimeError()
+    assert 'b' not in users and '2' not in orders  # aborted together
+
+    with orders.transaction(write=False) as orders_txn:
+        assert orders_txn['1'] == {'user': 'a'}
+
+    orders._flush()
+    assert len(orders) == 0 and len(users) == 1
+    users.close()
+    orders.close()
+    assert LmdbStore.open(path, name='users', strict=False, raw=True)['a'] == {'orders': 1}
+
+
+def _read_snapshot(args):
+    store, keys = args
+    return [store[key] for key in keys]
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="fork is not available on Windows")
+def test_lmdb_multiprocess():
+    import multiprocessing
+    import pickle
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    store = LmdbStore.open(path, strict=False, raw=True)
+    store.update({str(i): i for i in range(100)})
+    store.close()
+
+    snapshot = LmdbStore.open(path, flag='r', lock=False, strict=False, raw=True)
+    assert snapshot['1'] == 1  # opened in the parent before forking
+    assert pickle.loads(pickle.dumps(snapshot))['2'] == 2
+    with multiprocessing.get_context('fork').Pool(2) as pool:
+        results = pool.map(_read_snapshot, [(snapshot, [str(i) for i in range(j, 100, 4)]) for j in range(4)])
+    assert [result[0] for result in results] == [0, 1, 2, 3]
+    assert sum(map(len, results)) == 100
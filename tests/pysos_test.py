@@ -1,4 +1,5 @@
-from spoonbill.datastores.pysos import PysosStore
+import os
+from spoonbill.datastores.pysos import PysosStore, SnapshotDict
 from tempfile import TemporaryDirectory
 
 
@@ -69,3 +70,98 @@ def test_pysos_search():
     assert list(store.keys(pattern=1)) == [1]
     assert list(store.values(keys=['10', '13'])) == [
         {'a': 10, 'b': '10'}, {'a': 13, 'b': '13'}]
+
+
+def test_pysos_batch():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    store = PysosStore.open(path)
+    store.update({str(i): {'i': i} for i in range(1000)})
+    store.update({'1': 'updated', 'new': [1, 2]})
+    store['2'] = 'set'
+    assert len(store) == 1001 and store['1'] == 'updated' and store['999'] == {'i': 999}
+    store = PysosStore.open(path)  # the index is rebuilt from the file
+    assert len(store) == 1001 and store['1'] == 'updated' and store['new'] == [1, 2] and store['2'] == 'set'
+
+
+def test_pysos_group_commit():
+    from concurrent.futures import ThreadPoolExecutor
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    store = PysosStore.open(path, group_commit=0.01)
+    with ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(lambda i: store.set(i, i), range(100)))
+    assert store == {i: i for i in range(100)}
+    assert PysosStore.open(path) == {i: i for i in range(100)}
+
+
+def test_pysos_index_snapshot():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    store = PysosStore.open(path)
+    store.update({str(i): i for i in range(100)})
+    store.close()
+    assert os.path.exists(path + '.index')
+
+    store = PysosStore.open(path)
+    assert store._store._mark is not None  # opened from the snapshot
+    assert len(store) == 100 and store['10'] == 10
+    store['new'] = 'new'  # appended after the mark
+    store['10'] = 'updated'
+
+    store = PysosStore.open(path)  # not closed - the tail is replayed
+    assert store._store._mark is not None
+    assert len(store) == 101 and store['new'] == 'new' and store['10'] == 'updated'
+    store.snapshot()
+    assert store.pop('20') == 20  # commented out before the mark, and journaled
+    store['30'] = 'updated'
+
+    store = PysosStore.open(path)
+    assert store._store._mark is not None
+    assert len(store) == 100 and '20' not in store and store['30'] == 'updated'
+    store.close()
+    with open(path, 'r+b') as file:  # changed by someone else
+        file.seek(-3, os.SEEK_END)
+        file.write(b'99\n')
+    store = PysosStore.open(path)
+    assert store._store._mark is None and store['99'] == 99
+
+
+def test_pysos_snapshot_external_changes():
+    import pysos
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    store = PysosStore.open(path)
+    store.update({str(i): i for i in range(1000)})
+    store.close()
+
+    other = pysos.Dict(path)  # a writer which doesn't know about the snapshot
+    del other['5']
+    other['7'] = 'x'
+    other.close()
+    store = PysosStore.open(path)
+    assert store._store._mark is None  # the snapshot doesn't match the file
+    assert len(store) == 999 and '5' not in store and store['7'] == 'x'
+
+
+def test_pysos_snapshot_unchanged_file():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    store = PysosStore.open(path)
+    store.update({str(i): 'x' * 100 for i in range(1000)})
+    store.close()
+    assert os.path.getsize(path) > SnapshotDict.CHECKSUM_TAIL_SIZE
+
+    checksum = SnapshotDict._checksum
+    starts = []
+    SnapshotDict._checksum = lambda self, file, mark, restore=None, start=0: \
+        starts.append(start) or checksum(self, file, mark, restore, start)
+    try:
+        store = PysosStore.open(path)
+    finally:
+        SnapshotDict._checksum = checksum
+    assert store._store._mark is not None and len(store) == 1000
+    assert starts and 0 not in starts  # only the end of an unchanged file is read
+    store['1'] = 'y'  # the file changes, so the whole checksum is verified on the next open
+    store = PysosStore.open(path)
+    assert store._store._mark is not None and store['1'] == 'y'
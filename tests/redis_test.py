@@ -1,8 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 
 import redis
 import pytest
 import pathlib
+import time
 from spoonbill.datastores.redis import RedisStore
 
 
@@ -79,6 +81,141 @@ def test_redis_strict():
         store['1'] = {'1': 1}
 
 
+def test_redis_scan_pages():
+    store = RedisStore.open('redis://localhost:6379/1', strict=False, page_size=7)
+    store._flush()
+    store.update({i: i for i in range(100)})
+    assert set(store.keys()) == set(range(100))
+    assert set(store.values()) == set(range(100))
+    assert dict(store.items()) == {i: i for i in range(100)}
+    assert list(store.values(range(20))) == list(range(20))
+    assert len(list(store.keys(limit=15))) == 15
+    assert len(list(store.items(limit=15))) == 15
+    assert len(list(store.scan(limit=3))) == 3
+    assert list(store.keys(limit=0)) == []
+    store._flush()
+    assert list(store.scan()) == []
+
+
+def test_redis_batching():
+    store = RedisStore.open('redis://localhost:6379/1', strict=False, batch_window=0.01, batch_size=8)
+    store._flush()
+    with ThreadPoolExecutor(16) as pool:
+        assert all(pool.map(lambda i: store.set(i, {'i': i}), range(50)))
+        assert list(pool.map(store.get, range(50))) == [{'i': i} for i in range(50)]
+        assert list(pool.map(store.__contains__, range(48, 52))) == [True, True, False, False]
+    assert store.get('missing', 'default') == 'default'
+    store._flush()
+
+
+def test_redis_cache():
+    store = RedisStore.open('redis://localhost:6379/1', strict=True, cache_size=2)
+    other = RedisStore.open('redis://localhost:6379/1', strict=True)
+    store._flush()
+    store['a'] = 'a'
+    assert store['a'] == store['a'] == 'a'
+    assert store.cache.stats()['hits'] == 1
+    other['a'] = 'b'  # invalidated by redis
+    time.sleep(0.1)
+    assert store['a'] == 'b'
+    store['a'] = 'c'  # invalidated locally
+    assert store['a'] == 'c'
+    store.update({'b': 'b', 'c': 'c'})
+    assert [store[key] for key in 'abc'] == ['c', 'b', 'c']
+    assert store.cache.stats()['size'] == 2
+    store.close()
+    store._flush()
+
+
+def test_redis_cache_raw_client():
+    store = RedisStore.open('redis://localhost:6379/1', cache_size=2, decode_responses=False)
+    other = RedisStore.open('redis://localhost:6379/1', decode_responses=False)
+    store._flush()
+    store['a'] = 'a'
+    store[1] = 1
+    assert store['a'] == store['a'] == 'a' and store[1] == store[1] == 1
+    assert store.cache.stats()['hits'] == 2
+    other['a'] = 'b'  # invalidated by redis with a bytes key
+    other[1] = 2
+    time.sleep(0.1)
+    assert store['a'] == 'b' and store[1] == 2
+    assert set(store.keys()) == {'a', 1}
+    store.close()
+    store._flush()
+
+
+@pytest.mark.parametrize('strict', [True, False])
+def test_redis_hashes(strict):
+    store = RedisStore.open('redis://localhost:6379/1', strict=strict, hashes=True)
+    store._flush()
+    store['user'] = {'name': 'a', 'age': '1', 'city': 'x'}
+    assert store._store.type('user') == 'hash'
+    assert store['user'] == {'name': 'a', 'age': '1', 'city': 'x'}
+    assert store.get_fields('user', ['name', 'missing']) == {'name': 'a', 'missing': None}
+    store.set_fields('user', {'age': '2'})
+    assert store['user'] == {'name': 'a', 'age': '2', 'city': 'x'}
+    store.update({'other': {'name': 'b', 'age': '2'}, 'plain': 'value'})
+    assert sorted(key for key, _ in store.items({'age': '2'})) == ['other', 'user']
+    assert list(store.items({'name': 'b'})) == [('other', {'name': 'b', 'age': '2'})]
+    assert dict(store.items())['plain'] == 'value'
+    assert list(store.values(['user', 'plain', 'missing'])) == [store['user'], 'value', None]
+    store['user'] = 'replaced'
+    assert store['user'] == 'replaced'
+    assert store.pop('other') == {'name': 'b', 'age': '2'}
+    store._flush()
+
+
+def test_redis_set_fields():
+    store = RedisStore.open('redis://localhost:6379/1')
+    store._flush()
+    store['user'] = {'name': 'a', 'age': 1}
+    assert store.set_fields('user', {'age': 2, 'city': 'x'})
+    assert store._store.type('user') == 'string'
+    assert store['user'] == {'name': 'a', 'age': 2, 'city': 'x'}
+    assert store.set_fields('user', {})
+    assert store.set_fields('new', {'name': 'b'}) and store['new'] == {'name': 'b'}
+    store['plain'] = 'value'
+    with pytest.raises(TypeError):
+        store.set_fields('plain', {'name': 'c'})
+    store._flush()
+
+
+@pytest.mark.parametrize('strict', [True, False])
+def test_redis_atomic(strict):
+    store = RedisStore.open('redis://localhost:6379/1', strict=strict, hashes=True)
+    store._flush()
+    store['a'] = 'a'
+    store['h'] = {'f': 'v'}
+    assert store.pop('a') == 'a' and 'a' not in store
+    assert store.pop('h') == {'f': 'v'} and 'h' not in store
+    assert store.pop('a', 'default') == 'default'
+
+    assert store.setdefault('s', 'first') == 'first'
+    assert store.setdefault('s', 'second') == 'first'
+    assert store.setdefault('d', {'f': 'v'}) == {'f': 'v'}
+    assert store.setdefault('d', 'other') == {'f': 'v'}
+
+    assert store.compare_and_set('c', None, 'new', missing=True)
+    assert not store.compare_and_set('c', None, 'other', missing=True)
+    assert not store.compare_and_set('c', 'wrong', 'other')
+    assert store.compare_and_set('c', 'new', 'other') and store['c'] == 'other'
+
+    assert store.increment('n') == 1
+    assert store.increment('n', 5) == 6
+    assert int(store['n']) == 6
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: store.increment('n'), range(100)))
+    assert int(store['n']) == 106
+
+    items = {}
+    while len(store):
+        key, value = store.popitem()
+        items[key] = value
+    assert items == {'s': 'first', 'd': {'f': 'v'}, 'c': 'other', 'n': '106' if strict else 106}
+    with pytest.raises(KeyError):
+        store.popitem()
+
+
 @pytest.mark.skip("Experimental")
 def test_redis_save_load():
     tmpdir = TemporaryDirectory()
@@ -40,6 +40,7 @@ def test_shelve():
 
     store['function'] = lambda x: x + 1
     assert store['function'](1) == 2
+    store.close()
 
 
 def test_shelve_strict():
@@ -78,6 +79,7 @@ def test_shelve_strict():
 
     with pytest.raises((pickle.PickleError, AttributeError)):
         store['function'] = lambda x: x + 1
+    store.close()
 
 
 def test_shelve_save_load():
@@ -89,8 +91,10 @@ def test_shelve_save_load():
     store.save(other_path)
     store._flush()
     assert len(store) == 0
+    store.close()
     store = ShelveStore(local_path).load(other_path)
     assert len(store) == 1
+    store.close()
 
 
 def test_shelve_search():
@@ -106,3 +110,37 @@ def test_shelve_search():
     assert list(store.keys(pattern=1)) == [1]
     assert list(store.values(keys=['10', '13'])) == [
         {'a': 10, 'b': '10'}, {'a': 13, 'b': '13'}]
+    store.close()
+
+
+def test_shelve_checkout():
+    tmpdir = TemporaryDirectory()
+    path = tmpdir.name + '/tmp.db'
+    with ShelveStore.open(path, engine='dumb') as store:
+        store['test'] = {'a': [1]}
+        store['test']['a'].append(2)  # writeback is off
+        assert store['test'] == {'a': [1]}
+        value = store.checkout('test')
+        value['a'].append(2)
+        store.sync()
+        assert store['test'] == {'a': [1, 2]}
+        store.checkout('test')['a'].append(3)
+    with ShelveStore.open(path, engine='dumb') as store:
+        assert store['test'] == {'a': [1, 2, 3]}
+
+    store = ShelveStore.open(path, engine='dumb')
+    other = ShelveStore.open(path, engine='dumb')
+    assert other.shelf is store.shelf  # one handle per path
+    store.checkout('test')['a'].append(4)
+    other.close()  # the shelf stays open for store, and its checkout is written on close
+    store.close()
+    assert not store._users()
+    with ShelveStore.open(path, engine='dumb') as store:
+        assert store['test'] == {'a': [1, 2, 3, 4]}
+        with ShelveStore.open(path, engine='dumb') as other:
+            other['other'] = 1
+            other._flush()  # shared, so emptied in place
+        assert len(store) == 0
+
+    with pytest.raises(ValueError):
+        ShelveStore.open(tmpdir.name + '/other.db', engine='nope').shelf